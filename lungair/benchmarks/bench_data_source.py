@@ -0,0 +1,89 @@
+"""Benchmarks of the synthetic cohort generation and of loading LungAIR data sources.
+
+Run from this directory, with the fhir-sandbox repository on the PYTHONPATH
+(for its data_sources package):
+
+    python bench_data_source.py --cohort-sizes 50,500,5000,50000 --json results.json
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fhir-sandbox-config"))
+
+import lungair_data_source  # noqa: E402
+from bench_utils import Case, main  # noqa: E402
+
+SEED = 0
+
+
+def setup_generate(num_patients):
+    generator = lungair_data_source.SyntheticTableGenerator()
+    return lambda: generator.gen_batch(range(num_patients), seed=SEED), num_patients
+
+
+def setup_load(num_patients):
+    return lambda: lungair_data_source.LungairDataSource(None, range(num_patients), seed=SEED), num_patients
+
+
+def _iterate_observations(data_source):
+    for patient, observations in data_source.get_all_observations():
+        patient.get_dob()
+        for observation in observations:
+            observation.get_value()
+            observation.get_time()
+
+
+def setup_iterate(num_patients):
+    data_source = lungair_data_source.LungairDataSource(None, range(num_patients), seed=SEED)
+    return lambda: _iterate_observations(data_source), num_patients
+
+
+def setup_read_csv(num_patients):
+    table = lungair_data_source.SyntheticTableGenerator().gen_batch(range(num_patients), seed=SEED)
+    path = os.path.join(tempfile.mkdtemp(prefix="lungair-bench-"), "table.csv")
+    table.to_csv(path, index=False)
+    return lambda: lungair_data_source.read_table(path), num_patients
+
+
+def setup_streaming(num_patients):
+    table = lungair_data_source.SyntheticTableGenerator().gen_batch(range(num_patients), seed=SEED)
+    path = os.path.join(tempfile.mkdtemp(prefix="lungair-bench-"), "table.csv")
+    table.to_csv(path, index=False)
+    data_source = lungair_data_source.LungairStreamingDataSource(path, sorted_by_id=True, seed=SEED)
+    return lambda: _iterate_observations(data_source), num_patients
+
+
+def setup_fhir_bundles(num_patients):
+    data_source = lungair_data_source.LungairDataSource(None, range(num_patients), seed=SEED)
+
+    def serialize():
+        for _ in lungair_data_source.fhir_bundles(data_source, bundle_size=1000):
+            pass
+
+    return serialize, num_patients
+
+
+def cases(args):
+    sizes = [int(size) for size in args.cohort_sizes.split(",")]
+    all_cases = []
+    for size in sizes:
+        # keep the total run time reasonable for the largest cohorts
+        repeat = 5 if size <= 5000 else 1
+        all_cases += [
+            Case("generate", size, setup_generate, repeat=repeat),
+            Case("load", size, setup_load, repeat=repeat),
+            Case("iterate_observations", size, setup_iterate, repeat=repeat),
+            Case("read_csv", size, setup_read_csv, repeat=repeat),
+            Case("streaming_iterate", size, setup_streaming, repeat=repeat),
+            Case("fhir_bundles", size, setup_fhir_bundles, repeat=repeat, warmup=0),
+        ]
+    return all_cases
+
+
+def add_arguments(parser):
+    parser.add_argument("--cohort-sizes", default="50,500,5000,50000", help="comma-separated numbers of patients")
+
+
+if __name__ == "__main__":
+    sys.exit(main(os.path.abspath(__file__), cases, __doc__.splitlines()[0], add_arguments))
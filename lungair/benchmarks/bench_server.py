@@ -0,0 +1,131 @@
+"""Benchmarks of the LungAir server hot paths: image transport, median filter and segmentation.
+
+Runs offline on CPU with a randomly initialized UNETR checkpoint. Run from
+lungair/server with the server dependencies installed and the VolView server
+on the PYTHONPATH:
+
+    poetry run python ../benchmarks/bench_server.py --sizes 256,512,1024,2048 --json results.json
+"""
+import os
+import sys
+import tempfile
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+# Run the work in this process, so that the timings and peak RSS include it.
+os.environ.setdefault("LUNGAIR_EXECUTOR", "inline")
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import itk  # noqa: E402
+import numpy as np  # noqa: E402
+
+from bench_utils import Case, main  # noqa: E402
+
+SEED = 0
+
+
+def random_checkpoint() -> str:
+    """Save a randomly initialized segmentation model, once per benchmark machine."""
+    import lightning as L
+    import torch
+    from lungair_seg_inference import INPUT_SIZE, NUM_CLASSES, NetInference
+
+    path = os.path.join(tempfile.gettempdir(), f"lungair-bench-random-seed{SEED}.ckpt")
+    if not os.path.exists(path):
+        torch.manual_seed(SEED)
+        model = NetInference(INPUT_SIZE, NUM_CLASSES)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"state_dict": model.state_dict(), "pytorch-lightning_version": L.__version__}, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def synthetic_radiograph(size: int, slices: int = 1):
+    """A smooth chest-like pattern with noise, as a 3D unsigned short ITK image."""
+    rng = np.random.default_rng(SEED)
+    y, x = np.mgrid[-1 : 1 : size * 1j, -1 : 1 : size * 1j]
+    lungs = np.exp(-(((np.abs(x) - 0.4) / 0.25) ** 2 + (y / 0.6) ** 2))
+    image = 3000 * (1 - 0.7 * lungs) + rng.normal(0, 100, (slices, size, size))
+    image = itk.image_from_array(np.clip(image, 0, 65535).astype(np.uint16))
+    image.SetSpacing([0.2, 0.2, 1.0])
+    return image
+
+
+def setup_transport(size):
+    from lungair_transport import share_image, take_shared_image
+
+    image = synthetic_radiograph(size)
+    return lambda: take_shared_image(share_image(image)), 1
+
+
+def setup_median_filter(size):
+    from lungair_workers import do_median_filter
+    from lungair_transport import release_shared_image, share_image, take_shared_image
+
+    image = synthetic_radiograph(size)
+
+    def run():
+        shared_image = share_image(image)
+        try:
+            take_shared_image(do_median_filter(shared_image, 2))
+        finally:
+            release_shared_image(shared_image)
+
+    return run, 1
+
+
+def setup_segmentation(size):
+    from lungair_seg_inference import run_lungair_seg_inference
+
+    checkpoint = random_checkpoint()
+    image = synthetic_radiograph(size)
+    return lambda: run_lungair_seg_inference(image, checkpoint), 1
+
+
+def setup_segmentation_batch(size):
+    from lungair_seg_inference import run_lungair_seg_inference_batch
+
+    checkpoint = random_checkpoint()
+    images = [synthetic_radiograph(size) for _ in range(4)]
+    return lambda: run_lungair_seg_inference_batch(images, checkpoint), len(images)
+
+
+def setup_sliding_window(size):
+    from lungair_seg_inference import run_lungair_seg_inference_sliding_window
+
+    checkpoint = random_checkpoint()
+    image = synthetic_radiograph(size)
+    return lambda: run_lungair_seg_inference_sliding_window(image, checkpoint, [512, 512], sw_batch_size=4), 1
+
+
+def setup_volume_slices(size):
+    from lungair_seg_inference import run_lungair_seg_inference_slices
+
+    checkpoint = random_checkpoint()
+    slices = itk.array_from_image(synthetic_radiograph(size, slices=8))
+    return lambda: run_lungair_seg_inference_slices(slices, checkpoint), len(slices)
+
+
+def cases(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    all_cases = []
+    for size in sizes:
+        all_cases += [
+            Case("transport", size, setup_transport, repeat=20),
+            Case("median_filter", size, setup_median_filter),
+            Case("segmentation", size, setup_segmentation),
+            Case("segmentation_batch4", size, setup_segmentation_batch),
+            Case("volume_slices8", size, setup_volume_slices, repeat=3),
+        ]
+        if size > 512:
+            all_cases.append(Case("sliding_window", size, setup_sliding_window, repeat=3))
+    return all_cases
+
+
+def add_arguments(parser):
+    parser.add_argument("--sizes", default="256,512,1024,2048", help="comma-separated image sizes in pixels")
+
+
+if __name__ == "__main__":
+    sys.exit(main(os.path.abspath(__file__), cases, __doc__.splitlines()[0], add_arguments))
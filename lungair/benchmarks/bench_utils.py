@@ -0,0 +1,189 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+## Benchmark harness ##
+# Each case runs in a fresh subprocess, so that its peak RSS is measured on its
+# own and state such as loaded models does not leak between cases. The peak is
+# taken over the timed calls only, from the memory held after the setup and the
+# warm-up calls, which import modules and load models once. Results can be
+# saved as JSON and compared against a baseline to catch regressions.
+
+
+def _status_mb(field: str) -> float:
+    """A memory field of /proc/self/status in MiB, or None where there is none."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process, in MiB."""
+    rss = _status_mb("VmRSS")
+    return peak_rss_mb() if rss is None else rss
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process since the last `reset_peak_rss`, in MiB."""
+    peak = _status_mb("VmHWM")
+    if peak is None:
+        # ru_maxrss cannot be reset: the peak over the lifetime of the process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size to the current one, where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def time_calls(fn, repeat: int, warmup: int = 1, items: int = 1) -> dict:
+    """Call `fn` `warmup + repeat` times and summarize the timed calls.
+
+    `items` is the number of items (images, patients, ...) processed per call,
+    used to report throughput.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        "repeat": repeat,
+        "mean_s": float(times.mean()),
+        "p50_s": float(np.percentile(times, 50)),
+        "p90_s": float(np.percentile(times, 90)),
+        "p99_s": float(np.percentile(times, 99)),
+        "throughput_per_s": items / float(times.mean()),
+        "items": items,
+    }
+
+
+class Case:
+    """A benchmark case: `setup(param)` returns `(fn, items)`, where `fn` is the timed call."""
+
+    def __init__(self, name, param, setup, repeat=5, warmup=1):
+        self.name = name
+        self.param = param
+        self.setup = setup
+        self.repeat = repeat
+        self.warmup = warmup
+
+    @property
+    def id(self):
+        return f"{self.name}[{self.param}]"
+
+    def run(self, repeat=None):
+        fn, items = self.setup(self.param)
+        for _ in range(self.warmup):
+            fn()
+        setup_rss = rss_mb()
+        reset_peak_rss()
+        result = time_calls(fn, repeat or self.repeat, 0, items)
+        result["case"] = self.id
+        result["setup_rss_mb"] = setup_rss
+        result["peak_rss_mb"] = peak_rss_mb()
+        return result
+
+
+def _run_in_subprocess(script, case_id, extra_args):
+    command = [sys.executable, script, "--case", case_id, *extra_args]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        return {"case": case_id, "error": f"exit code {completed.returncode}"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_results(results):
+    print(
+        f"{'case':<40} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'items/s':>12} {'setup MiB':>10} {'peak MiB':>10}"
+    )
+    for result in results:
+        if "error" in result:
+            print(f"{result['case']:<40} failed: {result['error']}")
+            continue
+        print(
+            f"{result['case']:<40} {result['p50_s'] * 1000:>10.1f} {result['p90_s'] * 1000:>10.1f} "
+            f"{result['p99_s'] * 1000:>10.1f} {result['throughput_per_s']:>12.1f} "
+            f"{result.get('setup_rss_mb', float('nan')):>10.0f} {result['peak_rss_mb']:>10.0f}"
+        )
+
+
+def compare(results, baseline, tolerance):
+    """Return the cases whose median latency or peak RSS grew by more than `tolerance` over `baseline`."""
+    baseline = {result["case"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = baseline.get(result["case"])
+        if before is None or "error" in result or "error" in before:
+            continue
+        for metric in ("p50_s", "peak_rss_mb"):
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{result['case']}: {metric} {before[metric]:.4g} -> {result[metric]:.4g}")
+    return regressions
+
+
+def main(script, cases, description, add_arguments=None):
+    """Command line entry point shared by the benchmark scripts.
+
+    `cases` is a function of the parsed arguments returning the list of Cases.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--case", help="run a single case in this process and print its result as JSON")
+    parser.add_argument("-k", dest="filter", default="", help="only run cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=None, help="timed calls per case")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown (default 0.2)")
+    if add_arguments is not None:
+        add_arguments(parser)
+    args, _ = parser.parse_known_args()
+    all_cases = cases(args)
+
+    if args.case:
+        case = next(case for case in all_cases if case.id == args.case)
+        print(json.dumps(case.run(args.repeat)))
+        return 0
+
+    # forward everything but the harness options to the per-case subprocesses
+    extra_args = list(sys.argv[1:])
+    for option in ("--json", "--compare", "-k"):
+        if option in extra_args:
+            index = extra_args.index(option)
+            del extra_args[index : index + 2]
+
+    results = []
+    for case in all_cases:
+        if args.filter in case.id:
+            print(f"Running {case.id}...", file=sys.stderr)
+            results.append(_run_in_subprocess(script, case.id, extra_args))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,88 @@
+"""Check that the torch-native segmentation pre- and postprocessing match the MONAI pipeline.
+
+The reference is the dictionary pipeline the model was trained with: EnsureChannelFirstd,
+ToTensord, bilinear Resized to the model input size and NormalizeIntensityd, with the
+resize inverted by Invertd using nearest-neighbor interpolation. Run from lungair/server:
+
+    poetry run python ../benchmarks/check_seg_inference.py
+"""
+import sys
+
+import itk
+import numpy as np
+import torch
+from monai.transforms import Compose, EnsureChannelFirstd, Invertd, NormalizeIntensityd, Resized, ToTensord
+
+from bench_server import random_checkpoint, synthetic_radiograph
+
+import lungair_seg_inference as seg_inference
+
+# Largest allowed differences between the two pipelines
+MAX_INPUT_DIFFERENCE = 1e-4
+MAX_LABEL_MISMATCH = 1e-3  # fraction of pixels
+
+
+def reference_transforms():
+    return Compose([
+        EnsureChannelFirstd(keys=["image"], channel_dim="no_channel"),
+        ToTensord(keys=["image"]),
+        Resized(keys=["image"], spatial_size=seg_inference.INPUT_SIZE, mode="bilinear"),
+        NormalizeIntensityd(keys=["image"]),
+    ])
+
+
+def reference_preprocess(itk_img, transforms):
+    return transforms({"image": itk.array_from_image(itk_img).astype(int).squeeze()})
+
+
+def reference_postprocess(transform_dict, pred, transforms):
+    transform_dict["infer"] = pred
+    inverse = Invertd(keys="infer", transform=transforms, orig_keys="image", nearest_interp=True)
+    return inverse(transform_dict)["infer"].cpu().numpy().astype(np.ushort)
+
+
+def check(itk_img, checkpoint):
+    transforms = reference_transforms()
+    model = seg_inference.get_model(checkpoint)
+    with torch.inference_mode():
+        transform_dict = reference_preprocess(itk_img, transforms)
+        expected_input = torch.as_tensor(transform_dict["image"])
+        actual_input = seg_inference._preprocess_batch([itk_img])[0]
+        input_difference = float((expected_input - actual_input).abs().max())
+
+        # Compare the postprocessing on the same predictions
+        pred = torch.argmax(model(expected_input[None]), dim=1)
+        expected = reference_postprocess(transform_dict, pred.clone(), transforms)
+        actual = itk.array_view_from_image(seg_inference._labels_image(itk_img, pred[0].to(torch.uint8).numpy()))
+        label_mismatch = float(np.mean(expected != actual))
+
+    end_to_end = itk.array_view_from_image(seg_inference.run_lungair_seg_inference(itk_img, checkpoint))
+    end_to_end_mismatch = float(np.mean(expected != end_to_end))
+    return input_difference, label_mismatch, end_to_end_mismatch
+
+
+def main():
+    checkpoint = random_checkpoint()
+    failed = False
+    for size in (256, 512, 1000, 2048):
+        for dtype in (np.uint16, np.int16, np.float32):
+            image = synthetic_radiograph(size)
+            # integer-valued pixels, since the reference truncates to integers
+            image = itk.image_from_array(itk.array_from_image(image).astype(dtype))
+            input_difference, label_mismatch, end_to_end_mismatch = check(image, checkpoint)
+            ok = (
+                input_difference <= MAX_INPUT_DIFFERENCE
+                and label_mismatch == 0
+                and end_to_end_mismatch <= MAX_LABEL_MISMATCH
+            )
+            failed |= not ok
+            print(
+                f"{size}x{size} {np.dtype(dtype).name}: input max difference {input_difference:.2e}, "
+                f"label mismatch {label_mismatch:.2e}, end-to-end mismatch {end_to_end_mismatch:.2e}"
+                f"{'' if ok else '  FAILED'}"
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
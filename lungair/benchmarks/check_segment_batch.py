@@ -0,0 +1,84 @@
+"""Check that one bad image in a segmentLungsBatch request fails only its own result.
+
+Sends a worklist of two radiographs with a 3D volume between them, which the 2D
+model cannot segment, to segmentLungsBatch against an in-memory image store.
+Run from lungair/server with the VolView server on the PYTHONPATH:
+
+    poetry run python ../benchmarks/check_segment_batch.py
+"""
+import asyncio
+import os
+import sys
+
+from bench_server import random_checkpoint, synthetic_radiograph
+
+# random_checkpoint() already imported lungair_config, so set both the variable
+# for workers started by spawn and the configuration of this process.
+os.environ.setdefault("LUNGAIR_SEG_CHECKPOINT", random_checkpoint())
+import lungair_config  # noqa: E402
+
+lungair_config.SEG_MODEL_CHECKPOINT = os.environ["LUNGAIR_SEG_CHECKPOINT"]
+
+import lungair_methods  # noqa: E402
+
+EXPECTED_STATES = {"radiograph-1": "done", "volume": "failed", "radiograph-2": "done"}
+
+
+class ImageStore:
+    """The parts of the client "images" store used by segmentLungsBatch."""
+
+    def __init__(self, images):
+        self.images = dict(images)
+        self.dataIndex = self
+        self._uploads = 0
+
+    @property
+    async def idList(self):
+        return list(self.images)
+
+    async def _get(self, image_id):
+        return self.images[image_id]
+
+    def __getitem__(self, image_id):
+        return self._get(image_id)
+
+    async def addVTKImageData(self, name, image):
+        self._uploads += 1
+        image_id = f"upload-{self._uploads}"
+        self.images[image_id] = image
+        return image_id
+
+    async def updateData(self, image_id, image):
+        self.images[image_id] = image
+
+
+async def run_batch(store):
+    state = lungair_methods.ClientState()
+    lungair_methods.get_current_client_store = lambda name: store
+    lungair_methods.get_current_session = lambda default_factory: state
+    return [result async for result in lungair_methods.segment_lungs_batch(list(EXPECTED_STATES))]
+
+
+def main():
+    store = ImageStore({
+        "radiograph-1": synthetic_radiograph(256),
+        "volume": synthetic_radiograph(64, slices=4),
+        "radiograph-2": synthetic_radiograph(200),
+    })
+    results = asyncio.run(run_batch(store))
+    failed = len(results) != len(EXPECTED_STATES)
+    for result in results:
+        image_id = result["image_id"]
+        uploaded = result["seg_id"] in store.images
+        ok = result["state"] == EXPECTED_STATES[image_id] and uploaded == (result["state"] == "done")
+        failed |= not ok
+        print(
+            f"{image_id}: {result['state']}, seg_id {result['seg_id']}"
+            f"{', error: ' + result['error'] if result.get('error') else ''}"
+            f"{'' if ok else '  FAILED'}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
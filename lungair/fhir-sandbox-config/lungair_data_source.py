@@ -4,6 +4,13 @@ import datetime
 import sys
 import scipy.stats
 import json
+import os
+import itertools
+import functools
+import hashlib
+import glob
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from data_sources.patient_data_source import PatientDataSource, Patient, Observation
 
@@ -33,6 +40,22 @@ class DolGenerator:
         dol_count = np.clip(dol_count, 2, 250)
         return dol_start, dol_count
 
+    def gen_batch(self, n, rng):
+        """ Generate n (starting DOL, number of DOLs) pairs at once, returned as two integer arrays.
+        Args:
+            n: the number of time ranges to generate
+            rng: a numpy random Generator
+        """
+        dol_start = np.round(self.start_dist.rvs(size=n, random_state=rng)).astype(int)
+        dol_count = np.round(np.exp(self.log_counts_dist.rvs(size=n, random_state=rng)))
+        dol_count = np.clip(dol_count, 2, 250).astype(int)
+        return dol_start, dol_count
+
+def series_offsets(dol_count):
+    """ Return the offsets of consecutive time series of the given lengths in one flat array,
+    with an extra final entry holding the total length. """
+    return np.concatenate([[0], np.cumsum(dol_count)]).astype(int)
+
 class RegularTimeSeriesGenerator:
     """ Synthetic generator for time series data based on data from the LungAIR research group.
     This type of generator is suitable for a signal that has some kind of regularity, such as breathing or heart rate.
@@ -74,6 +97,42 @@ class RegularTimeSeriesGenerator:
             x_random[:] = (max_val + min_val) / 2
         return x_random
 
+    def gen_batch(self, dol_count, rng):
+        """ Generate one time series per entry of dol_count, concatenated into a single flat numpy array.
+        Series of equal length are generated together with a batched inverse FFT.
+        Args:
+            dol_count: integer array with the number of days of each time series
+            rng: a numpy random Generator
+        """
+        n = len(dol_count)
+        x_hat_random_split = self.x_hat_dist.rvs(size=n, random_state=rng).reshape(n, -1)
+        K = x_hat_random_split.shape[1] // 2
+        x_hat_random = x_hat_random_split[:, :K] + 1j * x_hat_random_split[:, K:]
+
+        minmax = self.minmax_dist.rvs(size=n, random_state=rng).reshape(n, 2)
+        min_val = np.maximum(0, minmax[:, 0])
+        max_val = np.maximum(min_val, minmax[:, 1])
+        if self.clip is not None:
+            min_val = np.clip(min_val, *(self.clip))
+            max_val = np.clip(max_val, *(self.clip))
+
+        offsets = series_offsets(dol_count)
+        x = np.empty(offsets[-1])
+        for num_days in np.unique(dol_count):
+            idx = np.flatnonzero(dol_count == num_days)
+            x_random = np.fft.irfft(x_hat_random[idx], n = num_days, axis=-1).real
+            x_min = x_random.min(axis=1, keepdims=True)
+            x_max = x_random.max(axis=1, keepdims=True)
+            lo, hi = min_val[idx, None], max_val[idx, None]
+            varies = np.abs(x_min-x_max) > 1e-5
+            x_random = np.where(
+                varies,
+                lo + (x_random - x_min) * (hi - lo) / np.where(varies, x_max - x_min, 1),
+                (hi + lo) / 2,
+            )
+            x[(offsets[idx, None] + np.arange(num_days)).ravel()] = x_random.ravel()
+        return x
+
 class PeaksTimeSeriesGenerator:
     """ Synthetic generator for time series data based on data from the LungAIR research group.
     This type of generator is suitable for an irregular signal that has a baseline value with a few peaks here and there.
@@ -160,6 +219,86 @@ class PeaksTimeSeriesGenerator:
         x = np.clip(x, *(self.clip))
         return x
 
+    def _draw_offsets(self, dol_start, dol_count, rng):
+        """ Draw peak center offsets the same way as gen does, with one row per peak. """
+        if self.earlier_peaks:
+            offset = rng.exponential(scale=dol_count//6, size=dol_count.shape)
+        else:
+            offset = rng.uniform(low=dol_start, high=dol_start+dol_count, size=dol_count.shape)
+        return np.clip(offset, 0, dol_count).astype(int)
+
+    def gen_batch(self, dol_start, dol_count, rng, chunk_size = 65536):
+        """ Generate one time series per patient, concatenated into a single flat numpy array.
+        The time points of each series are dol_start, dol_start+1, ..., dol_start+dol_count-1.
+        All random variates are drawn in bulk and the peaks are evaluated with broadcasting,
+        chunk_size peaks at a time.
+        Args:
+            dol_start: integer array with the first time point of each series
+            dol_count: integer array with the number of time points of each series
+            rng: a numpy random Generator
+        """
+        n = len(dol_count)
+        offsets = series_offsets(dol_count)
+        x = self.baseline * np.ones(offsets[-1])
+        if n == 0:
+            return x
+
+        num_peaks = self.num_peaks_dist.rvs(size=n, random_state=rng).astype(int)
+        peak_patient = np.repeat(np.arange(n), num_peaks) # peaks are sorted by patient
+        num_total_peaks = len(peak_patient)
+        peak_rank = np.arange(num_total_peaks) - np.repeat(series_offsets(num_peaks)[:-1], num_peaks)
+
+        height = np.clip(rng.exponential(scale=self.height_mean, size=num_total_peaks), 0, self.max_height)
+        fwhm = self.fwhm_dist.rvs(size=num_total_peaks, random_state=rng)
+        cut = rng.random(num_total_peaks) < self.cut_probability
+
+        peak_start = dol_start[peak_patient]
+        peak_count = dol_count[peak_patient]
+        if not self.prevent_stacking:
+            offset = self._draw_offsets(peak_start, peak_count, rng)
+        else:
+            # Like gen, try up to 30 candidate centers per peak and keep the first one that is further
+            # than 2*fwhm_mean from the previous peaks of the same series (or else the last candidate).
+            # Peaks are placed one rank at a time across all series, tracking blocked days in a grid.
+            attempts = 30
+            candidates = self._draw_offsets(
+                np.repeat(peak_start[:, None], attempts, axis=1),
+                np.repeat(peak_count[:, None], attempts, axis=1),
+                rng,
+            )
+            max_count = int(dol_count.max())
+            blocked = np.zeros((n, max_count + 1), dtype=bool)
+            reach = np.arange(-int(np.floor(2*self.fwhm_mean)), int(np.floor(2*self.fwhm_mean)) + 1)
+            offset = np.empty(num_total_peaks, dtype=int)
+            for rank in range(num_peaks.max(initial=0)):
+                peaks = np.flatnonzero(peak_rank == rank)
+                patients = peak_patient[peaks]
+                ok = ~blocked[patients[:, None], candidates[peaks]]
+                choice = np.where(ok.any(axis=1), ok.argmax(axis=1), attempts-1)
+                offset[peaks] = candidates[peaks, choice]
+                blocked[patients[:, None], np.clip(offset[peaks, None] + reach, 0, max_count)] = True
+        t0 = peak_start + offset
+
+        day = np.arange(int(dol_count.max()))
+        for chunk in range(0, num_total_peaks, chunk_size):
+            peaks = slice(chunk, chunk + chunk_size)
+            patients = peak_patient[peaks]
+            valid = day < dol_count[patients, None]
+            dt = (dol_start[patients, None] + day) - t0[peaks, None]
+
+            sigma = fwhm[peaks, None] / 2.355
+            peak = height[peaks, None] * np.exp( - dt**2 / (2 * sigma**2))
+            flatten_zone = valid & cut[peaks, None] & (np.abs(dt) < (fwhm[peaks, None]/2))
+            first_in_zone = flatten_zone.argmax(axis=1)
+            peak = np.where(flatten_zone, peak[np.arange(len(patients)), first_in_zone][:, None], peak)
+
+            if self.negative_peaks: peak = - peak
+
+            np.add.at(x, (offsets[patients, None] + day)[valid], peak[valid])
+
+        x = np.clip(x, *(self.clip))
+        return x
+
 
 class SyntheticTableGenerator:
     """A class to help initialize and manage all the synthetic data generators and produce
@@ -288,138 +427,724 @@ class SyntheticTableGenerator:
 
         return pd.concat(df_list)
 
+    def gen_batch(self, id_list=None, seed=None):
+        """ Like gen, but generate all patients at once with bulk random draws and build one table directly.
+        This is much faster for large cohorts. Rows are numbered consecutively across patients.
+
+        Args:
+            id_list: A list of patient/subject IDs, as for gen.
+            seed: Seed for the random number generator, for reproducible tables. Can be anything
+                accepted by numpy.random.default_rng, including a Generator.
+        """
+        rng = np.random.default_rng(seed)
+
+        if id_list is None:
+            id_list = list(range(50))
+        else:
+            id_list = list(id_list)
+        n = len(id_list)
+
+        dol_start, dol_count = self.dol_generator.gen_batch(n, rng)
+        offsets = series_offsets(dol_count)
+        patient = np.repeat(np.arange(n), dol_count) # patient index of each row
+        t = dol_start[patient] + (np.arange(offsets[-1]) - offsets[patient])
+
+        hr = np.round(self.hr_generator.gen_batch(dol_count, rng))
+        rr = np.round(self.rr_generator.gen_batch(dol_count, rng))
+        fio2 = self.fio2_generator.gen_batch(dol_start, dol_count, rng)
+        spo2 = np.round(self.spo2_generator.gen_batch(dol_start, dol_count, rng))
+
+        # on a certain interval we will make the pip and peep be data missing, like it is in our real dataset:
+        missing_start_time, missing_count = self.dol_generator.gen_batch(n, rng)
+        missing_start_time = missing_start_time[patient]
+        missing_mask = (t >= missing_start_time) & (t <= missing_start_time + missing_count[patient])
+
+        peep = np.round(self.peep_generator.gen_batch(dol_start, dol_count, rng))
+        peep[missing_mask] = np.nan
+
+        pip = np.round(self.pip_generator.gen_batch(dol_start, dol_count, rng))
+        pip[missing_mask] = np.nan
+
+        gender_code = rng.integers(2, size=n)
+
+        df = pd.DataFrame(
+            {
+                'ID':np.repeat(np.array(id_list, dtype=object), dol_count),
+                'Gender':gender_code[patient],
+                'DOL':t,
+                'HR (bpm)':hr,
+                'RR (bpm)':rr,
+                'SPO2 (%)':spo2,
+                'Supplemental O2 (FiO2)':fio2,
+                'PEEP (CmH2O)':peep,
+                'PIP (CmH2O)':pip,
+            }
+        )
+        for column_name in ['PEEP (CmH2O)', 'PIP (CmH2O)']:
+            column = df[column_name]
+            df[column_name] = column.astype(object).where(column.notna(), '*') # in our actual table * is used for missing data
+        return df
+
+
+_shard_table_gen = None
+
+def _gen_shard(shard_ids, seed_sequence, path, file_format):
+  """ Generate one shard of a synthetic table in a worker process and write it to path. """
+  global _shard_table_gen
+  if _shard_table_gen is None:
+    _shard_table_gen = SyntheticTableGenerator()
+  df = _shard_table_gen.gen_batch(shard_ids, seed=np.random.default_rng(seed_sequence))
+  if file_format == 'parquet':
+    df['ID'] = df['ID'].astype(str)
+    for column_name in ['PEEP (CmH2O)', 'PIP (CmH2O)']:
+      df[column_name] = df[column_name].astype(str) # mixed numbers and '*'
+    df.to_parquet(path, index=False)
+  else:
+    df.to_csv(path, index=False)
+  return path
+
+def gen_sharded(output_dir, id_list=None, seed=None, shard_size=10000, workers=None, file_format='csv'):
+  """ Generate a large synthetic table in shards across a process pool, writing each shard straight to disk.
+
+  The IDs are split into shards of shard_size consecutive IDs, and each shard gets its own random Generator
+  spawned from a SeedSequence for the given seed. The output therefore only depends on the seed and
+  shard_size, not on the number of workers, and only one shard per worker is held in memory.
+
+  Args:
+    output_dir: directory in which to write the shards, named shard-00000.csv, shard-00001.csv, ...
+    id_list: the list of patient IDs, as for SyntheticTableGenerator.gen
+    seed: seed for numpy.random.SeedSequence; if None, fresh entropy is used
+    shard_size: number of patients per shard
+    workers: number of worker processes, defaults to the number of CPUs
+    file_format: 'csv' or 'parquet' (parquet requires pyarrow)
+
+  Returns: the list of shard file paths, in ID order.
+  """
+  if file_format not in ('csv', 'parquet'):
+    raise ValueError(f"Unsupported file format: {file_format}")
+  id_list = list(range(50)) if id_list is None else list(id_list)
+  os.makedirs(output_dir, exist_ok=True)
+
+  shards = [id_list[i:i+shard_size] for i in range(0, len(id_list), shard_size)]
+  seed_sequences = np.random.SeedSequence(seed).spawn(len(shards))
+  paths = [os.path.join(output_dir, f'shard-{i:05d}.{file_format}') for i in range(len(shards))]
+
+  with ProcessPoolExecutor(workers) as executor:
+    return list(executor.map(_gen_shard, shards, seed_sequences, paths, [file_format]*len(shards)))
+
 
 # =====================================
 # === LungairDataSource definitions ===
 # =====================================
 
+# (observation type, spreadsheet column) pairs, in the order observations are emitted for each row
+OBSERVATION_COLUMNS = [
+  ('FIO2', 'Supplemental O2 (FiO2)'), # fraction inspired oxygen
+  ('HR', 'HR (bpm)'), # heart rate
+  ('PIP', 'PIP (CmH2O)'), # positive inspiratory pressure
+  ('PEEP', 'PEEP (CmH2O)'), # positive end expiratory pressure
+  ('SAO2', 'SPO2 (%)'), # blood oxygen saturation
+  ('RR', 'RR (bpm)'), # respiratory rate
+]
+
+OBSERVATION_TYPES = [observation_type for observation_type, _ in OBSERVATION_COLUMNS]
+
+# Factors applied to column values to get observation values
+OBSERVATION_SCALES = {
+  'Supplemental O2 (FiO2)': 100, # the FiO2 values in our table are fractions out of 1
+}
+
+def parse_observation_column(column : pd.Series) -> np.ndarray:
+  """ Convert a spreadsheet column to floats, with NaN wherever the value is missing
+  (marked by '*' or left empty). """
+  if pd.api.types.is_numeric_dtype(column):
+    return column.to_numpy(dtype=float)
+  values = column.astype(str).str.strip()
+  values = values.mask(values.isin(['*', '', 'nan']))
+  return pd.to_numeric(values).to_numpy(dtype=float)
+
+def observation_table(df : pd.DataFrame) -> pd.DataFrame:
+  """ Convert a LungAIR data table to long format, with one row per non-missing observation.
+
+  The result has columns 'row_number', 'ID', 'DOL', 'observation_type' (categorical, with the
+  categories OBSERVATION_TYPES) and 'value', and is ordered by spreadsheet row and then by the
+  order of OBSERVATION_COLUMNS.
+  """
+  num_types = len(OBSERVATION_COLUMNS)
+  values = np.column_stack([
+    parse_observation_column(df[column_name]) * OBSERVATION_SCALES.get(column_name, 1)
+    for _, column_name in OBSERVATION_COLUMNS
+  ])
+  table = pd.DataFrame({
+    'row_number' : np.repeat(df.index.to_numpy(), num_types),
+    'ID' : np.repeat(df['ID'].to_numpy(), num_types),
+    'DOL' : np.repeat(df['DOL'].to_numpy(dtype=int), num_types),
+    'observation_type' : pd.Categorical.from_codes(np.tile(np.arange(num_types), len(df)), OBSERVATION_TYPES),
+    'value' : values.ravel(),
+  })
+  return table[table['value'].notna()].reset_index(drop=True)
+
+TABLE_FILE_SUFFIXES = ('.csv', '.parquet', '.xlsx', '.xlsm', '.xls')
+
+def _table_files(data_file_path):
+  path = Path(data_file_path)
+  if path.is_dir():
+    return sorted(p for p in path.iterdir() if p.suffix.lower() in TABLE_FILE_SUFFIXES)
+  return [path]
+
+def _read_table_file(path, columns=None, cache=False):
+  suffix = path.suffix.lower()
+  if suffix == '.csv':
+    return pd.read_csv(path, usecols=columns, dtype={'ID':str})
+  if suffix == '.parquet':
+    return pd.read_parquet(path, columns=columns)
+  if cache:
+    return _read_excel_cached(path)
+  return pd.read_excel(path, usecols=columns, dtype={'ID':str})
+
+# Parsing a workbook with openpyxl is slow, so a typed Arrow copy of each parsed workbook is
+# kept next to it, in a file named after a hash of the workbook. The copy is memory-mapped on
+# later loads, and a changed workbook gets a new hash, which replaces the stale copy.
+
+def _table_cache_path(path):
+  stat = path.stat()
+  digest = hashlib.blake2b(repr((stat.st_size, stat.st_mtime_ns)).encode(), digest_size=16)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(2**20), b''):
+      digest.update(block)
+  return path.with_name(f".{path.name}.{digest.hexdigest()}.arrow")
+
+def _typed_table(df):
+  """ Give every column a single type that Arrow can store. Observation columns become floats
+  with NaN for missing values, which observation_table reads the same way as the original. """
+  df = df.copy()
+  df['ID'] = df['ID'].astype(str)
+  for _, column_name in OBSERVATION_COLUMNS:
+    if column_name in df.columns:
+      df[column_name] = parse_observation_column(df[column_name])
+  for column_name in df.columns:
+    if df[column_name].dtype == object:
+      df[column_name] = df[column_name].astype(str)
+  return df
+
+def _read_excel_cached(path):
+  try:
+    import pyarrow
+    import pyarrow.feather
+  except ImportError:
+    return pd.read_excel(path, dtype={'ID':str})
+
+  cache_path = _table_cache_path(path)
+  try:
+    with pyarrow.memory_map(str(cache_path)) as source:
+      return pyarrow.feather.read_table(source, memory_map=True).to_pandas()
+  except (FileNotFoundError, pyarrow.ArrowInvalid):
+    pass
+
+  df = _typed_table(pd.read_excel(path, dtype={'ID':str}))
+  try:
+    for stale_path in path.parent.glob(f".{glob.escape(path.name)}.*.arrow"):
+      stale_path.unlink()
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    pyarrow.feather.write_feather(df, str(tmp_path), compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+  except OSError as e:
+    print(f"Warning: could not cache the parsed table {path}: {e}", file=sys.stderr)
+  return df
+
+def read_table(data_file_path, cache=True):
+  """ Read a whole LungAIR data table from an Excel, CSV or Parquet file, or from a directory
+  of such files (e.g. shards written by gen_sharded), with a default integer index.
+
+  With cache=True (and pyarrow installed), parsed Excel workbooks are cached next to the data. """
+  df = pd.concat([_read_table_file(path, cache=cache) for path in _table_files(data_file_path)], ignore_index=True)
+  df['ID'] = df['ID'].astype(str)
+  return df
+
+def _read_table_file_chunks(path, chunk_size, columns=None):
+  suffix = path.suffix.lower()
+  if suffix == '.csv':
+    yield from pd.read_csv(path, usecols=columns, dtype={'ID':str}, chunksize=chunk_size)
+  elif suffix == '.parquet':
+    import pyarrow.parquet
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+      yield batch.to_pandas()
+  else:
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+      rows = workbook.active.iter_rows(values_only=True)
+      header = next(rows)
+      while True:
+        block = list(itertools.islice(rows, chunk_size))
+        if not block: break
+        chunk = pd.DataFrame(block, columns=header)
+        yield chunk if columns is None else chunk[columns]
+    finally:
+      workbook.close()
+
+def read_table_chunks(data_file_path, chunk_size=10000, columns=None):
+  """ Read a LungAIR data table in chunks of rows without loading it all in memory.
+
+  Supports the same inputs as read_table. Each chunk is indexed by row number, counting rows
+  the way they are shown in excel (starting at 2) and continuing across the files of a directory.
+  """
+  row_number = 2
+  for path in _table_files(data_file_path):
+    for chunk in _read_table_file_chunks(path, chunk_size, columns):
+      chunk.index = pd.RangeIndex(row_number, row_number + len(chunk))
+      chunk['ID'] = chunk['ID'].astype(str)
+      row_number += len(chunk)
+      yield chunk
+
 class LungairPatient(Patient):
 
-  def __init__(self, patient_info, synthetic=False):
-    self.patient_info = patient_info
-    self.dob = datetime.datetime(
-        year = np.random.choice(np.arange(2010,2012)),
-        month = np.random.choice(np.arange(1,13)),
-        day = np.random.choice(np.arange(1,28)),
-    )
+  __slots__ = ('patient_id', 'gender_code', 'dob', 'synthetic')
 
-    if synthetic:
-      self.identifier_system = 'ID assigned as part of synthetic data generation'
-    else:
-      self.identifier_system = "ID column from original data excel spreadsheet"
+  def __init__(self, patient_info, synthetic=False, rng=None):
+    """ Create a patient from a row of the LungAIR data table, with a random date of birth.
+
+    Only the ID and gender are kept from the row.
+
+    Args:
+      patient_info: A row of the data table for this patient
+      synthetic: Whether the patient is being populated with faked data.
+      rng: A numpy random Generator for the date of birth. Defaults to the global numpy random state.
+    """
+    rng = np.random if rng is None else rng
+    self.patient_id = str(patient_info['ID'])
+    self.gender_code = int(patient_info['Gender'])
+    self.dob = np.datetime64(datetime.date(
+        year = int(rng.choice(np.arange(2010,2012))),
+        month = int(rng.choice(np.arange(1,13))),
+        day = int(rng.choice(np.arange(1,28))),
+    ), 'D')
+    self.synthetic = synthetic
 
   def get_identifier_value(self):
-    return str(self.patient_info.loc['ID'])
+    return self.patient_id
 
   def get_identifier_system(self) -> str:
-    return self.identifier_system
+    if self.synthetic:
+      return 'ID assigned as part of synthetic data generation'
+    return "ID column from original data excel spreadsheet"
 
   def get_dob(self) -> str:
-    return self.dob.strftime("%Y-%m-%d")
+    return str(self.dob)
 
   def get_gender(self) -> Patient.Gender:
-     gender_code = int(self.patient_info.loc['Gender'])
-     if gender_code == 0:
+     if self.gender_code == 0:
         return Patient.Gender.FEMALE
-     elif gender_code == 1:
+     elif self.gender_code == 1:
         return Patient.Gender.MALE
      else:
         return Patient.Gender.UNKNOWN
 
-class LungairObservation(Observation):
+class ObservationBatch:
+  """ Observations stored as parallel arrays, one entry per observation.
 
-  def __init__(self, row_number, date, observation_type, observation_value, synthetic=False):
-    """ Create an observation based on an excel spreadsheet from the LungAIR research collaboration.
+  Indexing or iterating gives LungairObservation views, so a batch can be used wherever a list of
+  observations is expected without creating an object per observation up front. Dates are only
+  formatted when first asked for, all at once.
+  """
 
+  __slots__ = ('row_numbers', 'day_offsets', 'type_codes', 'values', 'dob', 'synthetic', '_times')
+
+  def __init__(self, row_numbers, day_offsets, type_codes, values, dob=None, synthetic=False):
+    """
     Args:
-      row_number: The row number from the spreadsheet that this observation came from
-      date: The date to associate to this observation. This might have to be faked to some extent.
-      observation_type: One of the types available as key values in observation_types.json
-      observation_value: The value taken on by the observation
-      synthetic: Whether the observation is being populated with faked data.
+      row_numbers: The spreadsheet row number of each observation
+      day_offsets: The day of life of each observation, added to dob to get its date
+      type_codes: The index in OBSERVATION_TYPES of the type of each observation
+      values: The value of each observation
+      dob: The date of birth (a numpy datetime64) of the patient the observations belong to
+      synthetic: Whether the observations are being populated with faked data.
     """
-    self.row_number = row_number
-    self.date = date
-    self.observation_type = observation_type
-    self.observation_value = observation_value
+    self.row_numbers = row_numbers
+    self.day_offsets = day_offsets
+    self.type_codes = type_codes
+    self.values = values
+    self.dob = dob
+    self.synthetic = synthetic
+    self._times = None
+
+  @classmethod
+  def from_table(cls, table:pd.DataFrame, dob=None, synthetic=False):
+    """ Create a batch from (part of) an observation_table. """
+    return cls(
+      row_numbers = table['row_number'].to_numpy(),
+      day_offsets = table['DOL'].to_numpy(),
+      type_codes = table['observation_type'].cat.codes.to_numpy(),
+      values = table['value'].to_numpy(),
+      dob = dob,
+      synthetic = synthetic,
+    )
 
-    if synthetic:
-      self.identifier_system = 'Row number in synthetically generated data table'
-    else:
-      self.identifier_system = 'Row number in the excel spreadsheet that was used to generate this Observation'
+  def take(self, indices, dob):
+    """ Create a batch of the observations at the given positions, for a patient born on dob. """
+    return ObservationBatch(
+      self.row_numbers[indices], self.day_offsets[indices], self.type_codes[indices], self.values[indices],
+      dob = dob, synthetic = self.synthetic,
+    )
+
+  @property
+  def times(self) -> np.ndarray:
+    """ The formatted date of each observation. """
+    if self._times is None:
+      self._times = np.datetime_as_string(self.dob + self.day_offsets.astype('timedelta64[D]'), unit='D')
+    return self._times
+
+  def __len__(self):
+    return len(self.values)
+
+  def __getitem__(self, index):
+    if index < 0: index += len(self)
+    if not 0 <= index < len(self): raise IndexError(index)
+    return LungairObservation(self, index)
+
+  def __iter__(self):
+    return (LungairObservation(self, index) for index in range(len(self)))
+
+class LungairObservation(Observation):
+  """ An observation based on an excel spreadsheet from the LungAIR research collaboration.
+
+  This is a view of one entry of an ObservationBatch.
+  """
+
+  __slots__ = ('batch', 'index')
+
+  def __init__(self, batch:ObservationBatch, index:int):
+    self.batch = batch
+    self.index = index
 
   def get_identifier_value(self):
-    return str(self.row_number)
+    return str(self.batch.row_numbers[self.index])
 
   def get_identifier_system(self):
-    return self.identifier_system
+    if self.batch.synthetic:
+      return 'Row number in synthetically generated data table'
+    return 'Row number in the excel spreadsheet that was used to generate this Observation'
 
   def get_observation_type(self):
-    return self.observation_type
+    """ One of the types available as key values in observation_types.json """
+    return OBSERVATION_TYPES[self.batch.type_codes[self.index]]
 
   def get_value(self):
-    return self.observation_value
+    return float(self.batch.values[self.index])
 
   def get_time(self):
-    return self.date.strftime("%Y-%m-%d")
+    return str(self.batch.times[self.index])
+
+def make_observations(patient:LungairPatient, table:pd.DataFrame, synthetic=False):
+  """ Create the observations of a patient from their rows of an observation_table. """
+  return ObservationBatch.from_table(table, patient.dob, synthetic)
 
 class LungairDataSource(PatientDataSource):
 
-  def __init__(self, data_file_path, id_list):
+  def __init__(self, data_file_path, id_list, seed=None, table_cache=True):
 
     self.synthetic : bool = data_file_path is None
+    # Random state for dates of birth; seeded for reproducible patients.
+    self.rng = np.random.default_rng(seed) if seed is not None else None
 
     if not self.synthetic:
       if id_list is not None:
         print("Warning: id_list is only used with synthetic data generation, i.e. when "
               "data_file_path is null. It is ignored currently.", file=sys.stderr)
-      self.df = pd.read_excel(
-        data_file_path,
-        dtype = {
-          'ID':str
-        }
-      )
+      self.df = read_table(data_file_path, cache=table_cache)
     else:
       table_gen = SyntheticTableGenerator()
-      self.df = table_gen.gen(id_list)
+      self.df = table_gen.gen_batch(id_list, seed=seed)
       self.df['ID'] = self.df['ID'].astype(str)
 
     self.df.index += 2 # match index with row numbers shown in excel
 
+    # Parse all observations once, and index them by patient ID
+    self.observations = observation_table(self.df)
+    self.observation_rows_by_id = self.observations.groupby('ID', sort=False).indices
+    self.observation_batch = ObservationBatch.from_table(self.observations, synthetic=self.synthetic)
+
   def get_all_patients(self):
     unique_patients = self.df.drop_duplicates('ID')
-    return (LungairPatient(row, synthetic = self.synthetic) for _, row in unique_patients.iterrows())
+    return (LungairPatient(row, synthetic = self.synthetic, rng = self.rng) for _, row in unique_patients.iterrows())
 
   def get_patient_observations(self, patient:LungairPatient):
     patient_id = patient.get_identifier_value()
-    observations_for_patient_df = self.df[self.df['ID']==patient_id]
-    observations = []
-    for row_number, row in observations_for_patient_df.iterrows():
-      date = patient.dob + datetime.timedelta(days=int(row['DOL']))
-
-      for observation_type, column_name in [
-        ('FIO2', 'Supplemental O2 (FiO2)'), # fraction inspired oxygen
-        ('HR', 'HR (bpm)'), # heart rate
-        ('PIP', 'PIP (CmH2O)'), # positive inspiratory pressure
-        ('PEEP', 'PEEP (CmH2O)'), # positive end expiratory pressure
-        ('SAO2', 'SPO2 (%)'), # blood oxygen saturation
-        ('RR', 'RR (bpm)'), # respiratory rate
-      ]:
-        value_raw = str(row[column_name]).strip()
-        value_is_missing = value_raw in ['*', '']
-        if value_is_missing: continue
-        value = float(value_raw)
-
-        if column_name=='Supplemental O2 (FiO2)': value *= 100 # the FiO2 values in our table are fractions out of 1
-
-        observations.append(
-          LungairObservation(
-            row_number = row_number,
-            date = date,
-            observation_type = observation_type,
-            observation_value = value,
-            synthetic = self.synthetic,
-          )
-        )
+    rows = self.observation_rows_by_id.get(patient_id, np.array([], dtype=int))
+    return self.observation_batch.take(rows, patient.dob)
+
+  def get_all_observations(self):
+    """ Generate (patient, observations) pairs for all patients. Each row of the observation table is visited once. """
+    for patient in self.get_all_patients():
+      yield patient, self.get_patient_observations(patient)
+
 
-    return observations
+class LungairStreamingDataSource(PatientDataSource):
+  """ A LungairDataSource that reads its data table in chunks and generates patients lazily,
+  so that patients can be loaded while the file is still being read.
+
+  Rows of the same patient are grouped incrementally. If the table is sorted by ID, a patient
+  is complete as soon as a row with another ID is read. Otherwise a pre-pass reads only the
+  ID column to find the last row of each patient.
+  """
+
+  def __init__(self, data_file_path, chunk_size=10000, sorted_by_id=False, seed=None):
+    """
+    Args:
+      data_file_path: an Excel, CSV or Parquet file, or a directory of such files
+      chunk_size: number of rows to read at a time
+      sorted_by_id: whether all rows of each patient are contiguous in the table
+      seed: seed for the random dates of birth
+    """
+    self.data_file_path = data_file_path
+    self.chunk_size = chunk_size
+    self.sorted_by_id = sorted_by_id
+    self.synthetic = False
+    self.rng = np.random.default_rng(seed) if seed is not None else None
+    self.pending_observations = {} # patient ID -> observations of patients generated by get_all_patients
+
+  def _last_rows(self):
+    """ Map each patient ID to the row number of its last row, reading only the ID column. """
+    last_rows = {}
+    for chunk in read_table_chunks(self.data_file_path, self.chunk_size, columns=['ID']):
+      last_rows.update(chunk.index.to_series().groupby(chunk['ID'].to_numpy(), sort=False).max().items())
+    return last_rows
+
+  def get_all_observations(self):
+    """ Lazily generate (patient, observations) pairs while the data table is being read. """
+    last_rows = None if self.sorted_by_id else self._last_rows()
+    pending = {} # patient ID -> (first row, pieces of the observation table), in order of appearance
+
+    def complete(patient_id):
+      row, pieces = pending.pop(patient_id)
+      patient = LungairPatient(row, synthetic = self.synthetic, rng = self.rng)
+      return patient, make_observations(patient, pd.concat(pieces), self.synthetic)
+
+    for chunk in read_table_chunks(self.data_file_path, self.chunk_size):
+      table = observation_table(chunk)
+      first_rows = chunk.drop_duplicates('ID')
+      for row_number, patient_id in zip(first_rows.index, first_rows['ID']):
+        if patient_id not in pending:
+          pending[patient_id] = (chunk.loc[row_number], [table.iloc[:0]])
+      for patient_id, piece in table.groupby('ID', sort=False):
+        pending[patient_id][1].append(piece)
+
+      if self.sorted_by_id:
+        last_id = chunk['ID'].iloc[-1]
+        done = [patient_id for patient_id in pending if patient_id != last_id]
+      else:
+        chunk_end = chunk.index[-1]
+        done = [patient_id for patient_id in pending if last_rows[patient_id] <= chunk_end]
+      for patient_id in done:
+        yield complete(patient_id)
+
+    for patient_id in list(pending):
+      yield complete(patient_id)
+
+  def get_all_patients(self):
+    for patient, observations in self.get_all_observations():
+      self.pending_observations[patient.get_identifier_value()] = observations
+      yield patient
+
+  def get_patient_observations(self, patient:LungairPatient):
+    # Observations are handed over once, so memory is released as patients are loaded.
+    return self.pending_observations.pop(patient.get_identifier_value(), [])
+
+
+## Bulk FHIR export ##
+# Loading a cohort one resource per request takes hundreds of thousands of requests. Instead,
+# patients and their observations can be serialized directly into FHIR transaction Bundles, or
+# into NDJSON files for a bulk $import. Resources get IDs derived from their identifiers and are
+# written with PUT, so bundles are independent of each other and can be loaded again safely.
+
+@functools.lru_cache(maxsize=None)
+def load_observation_codings(path=None) -> dict:
+  """ Read the coding of each observation type from observation_types.json, the file with which the
+  fhir-sandbox loader codes observations, so that bulk exports code them the same way.
+
+  Args:
+    path: the observation_types.json file; by default the one of the fhir-sandbox repository
+      providing the data_sources package.
+  Returns a dict from observation type to a list of FHIR Codings, or None for types listed without a code.
+  """
+  if path is None:
+    path = Path(sys.modules[PatientDataSource.__module__].__file__).resolve().parent.parent/'observation_types.json'
+  with open(path) as f:
+    observation_types = json.load(f)
+  codings = {}
+  for observation_type, entry in observation_types.items():
+    concept = entry.get('code') if isinstance(entry.get('code'), dict) else entry
+    if concept.get('coding'):
+      codings[observation_type] = list(concept['coding'])
+    elif concept.get('code'):
+      codings[observation_type] = [{key : concept[key] for key in ('system', 'code', 'display') if key in concept}]
+    else:
+      codings[observation_type] = None
+  return codings
+
+_uncoded_types_reported = set()
+
+def observation_codes(codings=None) -> dict:
+  """ The FHIR CodeableConcept of each observation type, from observation_types.json updated with codings.
+
+  A FHIR Observation code needs a coding, so types without one are left out, with a warning, and their
+  observations are not exported.
+  """
+  codings = {**load_observation_codings(), **(codings or {})}
+  codes = {}
+  for observation_type in OBSERVATION_TYPES:
+    coding = codings.get(observation_type)
+    if not coding:
+      if observation_type not in _uncoded_types_reported:
+        _uncoded_types_reported.add(observation_type)
+        print(f"Warning: observation type {observation_type} has no coding, its observations are not exported. "
+              "Add one to observation_types.json or pass it in codings.", file=sys.stderr)
+      continue
+    codes[observation_type] = {'coding' : coding if isinstance(coding, list) else [coding], 'text' : observation_type}
+  return codes
+
+# UCUM units of the observation values
+OBSERVATION_UNITS = {
+  'FIO2' : '%',
+  'HR' : '/min',
+  'SAO2' : '%',
+  'RR' : '/min',
+  'PIP' : 'cm[H2O]',
+  'PEEP' : 'cm[H2O]',
+}
+
+FHIR_ID_NAMESPACE = uuid.UUID('6f1d5a0e-3c2b-4f7e-9a41-1b7c0d2e8f53')
+
+def _fhir_id(*parts):
+  return str(uuid.uuid5(FHIR_ID_NAMESPACE, '|'.join(map(str, parts))))
+
+def patient_resource(patient:Patient) -> dict:
+  return {
+    'resourceType' : 'Patient',
+    'id' : _fhir_id('Patient', patient.get_identifier_system(), patient.get_identifier_value()),
+    'identifier' : [{'system' : patient.get_identifier_system(), 'value' : patient.get_identifier_value()}],
+    'gender' : patient.get_gender().name.lower(),
+    'birthDate' : patient.get_dob(),
+  }
+
+def observation_resources(patient:Patient, observations, codings=None) -> list:
+  """ Serialize the observations of a patient as FHIR Observation resources. """
+  codes = observation_codes(codings)
+  patient_reference = {'reference' : f"Patient/{patient_resource(patient)['id']}"}
+
+  if isinstance(observations, ObservationBatch):
+    identifier_system = observations[0].get_identifier_system() if len(observations) else None
+    rows = zip(
+      observations.row_numbers.tolist(),
+      [OBSERVATION_TYPES[code] for code in observations.type_codes.tolist()],
+      observations.values.tolist(),
+      observations.times.tolist(),
+    )
+  else:
+    identifier_system = observations[0].get_identifier_system() if observations else None
+    rows = (
+      (o.get_identifier_value(), o.get_observation_type(), o.get_value(), o.get_time())
+      for o in observations
+    )
+
+  return [
+    {
+      'resourceType' : 'Observation',
+      'id' : _fhir_id('Observation', identifier_system, row_number, observation_type),
+      'status' : 'final',
+      'identifier' : [{'system' : identifier_system, 'value' : str(row_number)}],
+      'code' : codes[observation_type],
+      'subject' : patient_reference,
+      'effectiveDateTime' : time,
+      'valueQuantity' : {
+        'value' : value,
+        'unit' : OBSERVATION_UNITS.get(observation_type),
+        'system' : 'http://unitsofmeasure.org',
+        'code' : OBSERVATION_UNITS.get(observation_type),
+      },
+    }
+    for row_number, observation_type, value, time in rows
+    if observation_type in codes
+  ]
+
+def fhir_resources(data_source:PatientDataSource, codings=None):
+  """ Generate the FHIR resources of all patients of a data source, each patient followed by its observations. """
+  for patient, observations in data_source.get_all_observations():
+    yield patient_resource(patient)
+    yield from observation_resources(patient, observations, codings)
+
+def fhir_bundles(data_source:PatientDataSource, bundle_size=1000, codings=None):
+  """ Generate FHIR transaction Bundles of at most bundle_size entries with all the resources of a data source. """
+  resources = fhir_resources(data_source, codings)
+  while True:
+    entries = [
+      {'resource' : resource, 'request' : {'method' : 'PUT', 'url' : f"{resource['resourceType']}/{resource['id']}"}}
+      for resource in itertools.islice(resources, bundle_size)
+    ]
+    if not entries: break
+    yield {'resourceType' : 'Bundle', 'type' : 'transaction', 'entry' : entries}
+
+def write_fhir_bundles(data_source:PatientDataSource, output_dir, bundle_size=1000, codings=None):
+  """ Write FHIR transaction Bundles to numbered JSON files in output_dir, and return their paths. """
+  output_dir = Path(output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  paths = []
+  for bundle_index, bundle in enumerate(fhir_bundles(data_source, bundle_size, codings)):
+    path = output_dir/f'bundle-{bundle_index:05d}.json'
+    with open(path, 'w') as f:
+      json.dump(bundle, f)
+    paths.append(path)
+  return paths
+
+def write_fhir_ndjson(data_source:PatientDataSource, output_dir, codings=None):
+  """ Write the resources of a data source to Patient.ndjson and Observation.ndjson in output_dir,
+  as expected by a FHIR bulk $import, and return their paths. """
+  output_dir = Path(output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  paths = {resource_type : output_dir/f'{resource_type}.ndjson' for resource_type in ('Patient', 'Observation')}
+  files = {resource_type : open(path, 'w') for resource_type, path in paths.items()}
+  try:
+    for resource in fhir_resources(data_source, codings):
+      f = files[resource['resourceType']]
+      f.write(json.dumps(resource))
+      f.write('\n')
+  finally:
+    for f in files.values():
+      f.close()
+  return list(paths.values())
+
+def post_fhir_bundles(data_source:PatientDataSource, fhir_server, bundle_size=1000, codings=None):
+  """ Load all resources of a data source into a FHIR server, one transaction Bundle per request.
+
+  Args:
+    fhir_server: the base URL of the FHIR server, e.g. http://localhost:3000/hapi-fhir-jpaserver/fhir/
+  Returns the number of bundles posted.
+  """
+  import urllib.request
+  num_bundles = 0
+  for bundle in fhir_bundles(data_source, bundle_size, codings):
+    request = urllib.request.Request(
+      fhir_server,
+      data = json.dumps(bundle).encode(),
+      headers = {'Content-Type' : 'application/fhir+json'},
+      method = 'POST',
+    )
+    with urllib.request.urlopen(request) as response:
+      response.read()
+    num_bundles += 1
+  return num_bundles
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Generate a large synthetic LungAIR data table in shards.')
+  parser.add_argument('output_dir', help='directory in which to write the shards')
+  parser.add_argument('--num-patients', type=int, default=50)
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--shard-size', type=int, default=10000)
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+  args = parser.parse_args()
+  paths = gen_sharded(args.output_dir, range(args.num_patients), seed=args.seed, shard_size=args.shard_size,
+                      workers=args.workers, file_format=args.format)
+  print(f"Wrote {len(paths)} shards to {args.output_dir}")
@@ -0,0 +1,121 @@
+import asyncio
+from dataclasses import dataclass, field
+
+
+@dataclass
+class BatchStats:
+    requests: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    max_queue_depth: int = 0
+    # batch size -> number of batches of that size
+    batch_sizes: dict = field(default_factory=dict)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "max_queue_depth": self.max_queue_depth,
+            "batch_sizes": dict(self.batch_sizes),
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+
+class MicroBatcher:
+    """Collects requests arriving within a short window and runs them as one batch.
+
+    `run_batch` is an async callable taking a list of items and returning a list
+    of results in the same order. A batch is dispatched as soon as it reaches
+    `max_batch_size`, or `window` seconds after its first item was queued.
+    When a batch fails, its items are retried one by one, so that one bad item
+    only fails its own request.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, window=0.02):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window
+        self.stats = BatchStats()
+        self._pending = []
+        self._in_flight = 0
+        self._timer = None
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self.stats.requests += 1
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.queue_depth)
+
+        if self.queue_depth >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Skip requests whose callers have gone away in the meantime.
+        pending = [(item, future) for item, future in self._pending if not future.done()]
+        batch = pending[: self.max_batch_size]
+        self._pending = pending[self.max_batch_size :]
+
+        if self._pending:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.window, self._flush)
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        size = len(batch)
+        self.stats.batches += 1
+        self.stats.batch_sizes[size] = self.stats.batch_sizes.get(size, 0) + 1
+        self._in_flight += size
+        print(f"Running batch of {size} (queued: {self.queue_depth}).")
+        try:
+            try:
+                results = await self.run_batch([item for item, _ in batch])
+            except Exception as exc:
+                self.stats.failed_batches += 1
+                if size == 1:
+                    self._set_exception(batch[0][1], exc)
+                    return
+                print(f"Batch of {size} failed ({exc}), retrying its items one by one.")
+                await self._run_one_by_one(batch)
+                return
+        finally:
+            self._in_flight -= size
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _run_one_by_one(self, batch):
+        for item, future in batch:
+            if future.done():
+                continue
+            try:
+                (result,) = await self.run_batch([item])
+            except Exception as exc:
+                self._set_exception(future, exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exc):
+        if not future.done():
+            future.set_exception(exc)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+## Content-addressed result cache ##
+# Results are keyed by a hash of the input pixels and geometry together with
+# the operation name and its parameters, so identical requests from any
+# session reuse the same output.
+
+
+def image_digest(itk_img) -> str:
+    import itk
+
+    array = itk.array_view_from_image(itk_img)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    digest.update(np.asarray(itk_img.GetOrigin(), dtype=float).tobytes())
+    digest.update(np.asarray(itk_img.GetSpacing(), dtype=float).tobytes())
+    digest.update(itk.array_from_matrix(itk_img.GetDirection()).astype(float).tobytes())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def result_key(digest: str, operation: str, **params) -> str:
+    description = json.dumps([digest, operation, params], sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def as_dict(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ResultCache:
+    """LRU cache of ITK images bounded by total pixel bytes, with an optional on-disk tier.
+
+    Entries evicted from memory stay available on disk when `disk_dir` is set;
+    the disk tier is bounded by `max_disk_bytes`, dropping least recently used
+    files first. All methods are thread-safe, so lookups that hit the disk
+    tier can run off the event loop.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = None, max_disk_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = CacheStats()
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return image
+
+            image = self._load(key)
+            if image is not None:
+                self.stats.disk_hits += 1
+                self._insert(key, image)
+                return image
+
+            self.stats.misses += 1
+            return None
+
+    def put(self, key: str, image):
+        with self._lock:
+            self._insert(key, image)
+            self._store(key, image)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _insert(self, key, image):
+        size = _image_nbytes(image)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= _image_nbytes(self._entries.pop(key))
+        self._entries[key] = image
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _image_nbytes(evicted)
+            self.stats.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.npz")
+
+    def _load(self, key):
+        import itk
+
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                image = itk.image_from_array(data["pixels"], is_vector=bool(data["is_vector"]))
+                image.SetOrigin(data["origin"].tolist())
+                image.SetSpacing(data["spacing"].tolist())
+                image.SetDirection(itk.matrix_from_array(data["direction"]))
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return image
+
+    def _store(self, key, image):
+        import itk
+
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                pixels=itk.array_view_from_image(image),
+                is_vector=image.GetNumberOfComponentsPerPixel() > 1,
+                origin=np.asarray(image.GetOrigin(), dtype=float),
+                spacing=np.asarray(image.GetSpacing(), dtype=float),
+                direction=itk.array_from_matrix(image.GetDirection()),
+            )
+        os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        if not self.max_disk_bytes:
+            return
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _image_nbytes(image) -> int:
+    import itk
+
+    return itk.array_view_from_image(image).nbytes
@@ -0,0 +1,105 @@
+import os
+import tempfile
+
+## LungAir server settings ##
+# All settings are read from environment variables at startup.
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Rough host memory needed to run one 512x512 slice through UNETR on CPU.
+SLICE_MEMORY_ESTIMATE = 256 * 2**20
+
+
+def slice_batch_size(num_workers: int = 1, max_batch_size: int = 32) -> int:
+    """Number of slices per forward pass so that all workers fit in half the available memory."""
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4
+    return min(max(1, available // 2 // max(1, num_workers) // SLICE_MEMORY_ESTIMATE), max_batch_size)
+
+
+SEG_MODEL_CHECKPOINT = os.environ.get(
+    "LUNGAIR_SEG_CHECKPOINT", "./segmentLungsModel-v1.0.ckpt"
+)
+
+# Input size of the segmentation model
+SEG_INPUT_SIZE = [512, 512]
+
+# Inference engine: "eager" (PyTorch), "torchscript" or "onnx" (onnxruntime, CPU)
+SEG_ENGINE = os.environ.get("LUNGAIR_SEG_ENGINE", "eager")
+# Quantize the linear layers of the model to int8 (CPU only)
+SEG_QUANTIZE = bool(_env_int("LUNGAIR_SEG_QUANTIZE", 0))
+# Minimum Dice between an exported or quantized engine and the fp32 model
+SEG_MIN_DICE = _env_float("LUNGAIR_SEG_MIN_DICE", 0.98)
+# Radiograph file, or directory of radiographs, on which that Dice is measured;
+# by default synthetic chest-like images
+SEG_CALIBRATION_IMAGES = os.environ.get("LUNGAIR_SEG_CALIBRATION_IMAGES")
+
+# Execution backends: "process", "thread" or "inline"
+EXECUTOR = os.environ.get("LUNGAIR_EXECUTOR", "process")
+# Separate worker groups, so that segmentation cannot starve median filtering
+SEG_WORKERS = _env_int("LUNGAIR_SEG_WORKERS", max(1, min(4, available_cpus() // 4)))
+MEDIAN_WORKERS = _env_int("LUNGAIR_MEDIAN_WORKERS", max(1, min(4, available_cpus() // 4)))
+# ITK and torch threads in each worker; by default the CPUs are split evenly
+# between all workers so that they do not oversubscribe the machine.
+THREADS_PER_WORKER = _env_int(
+    "LUNGAIR_THREADS_PER_WORKER",
+    max(1, available_cpus() // (SEG_WORKERS + MEDIAN_WORKERS)),
+)
+# Pin each process worker to its own CPUs, segmentation workers first
+PIN_WORKERS = bool(_env_int("LUNGAIR_PIN_WORKERS", 1))
+
+# Base images kept on the server per session for repeated median filtering
+RESIDENT_IMAGES = _env_int("LUNGAIR_RESIDENT_IMAGES", 2)
+# Bytes of resident base images kept by the server across all sessions
+RESIDENT_MAX_BYTES = _env_int("LUNGAIR_RESIDENT_MAX_MB", 1024) * 2**20
+# Derived images (blurred images, label maps, ...) remembered per session, and
+# for how long after their last use
+SESSION_MAX_DERIVED = _env_int("LUNGAIR_SESSION_MAX_DERIVED", 64)
+SESSION_DERIVED_TTL = _env_float("LUNGAIR_SESSION_DERIVED_TTL_S", 24 * 3600)
+# Wait this long before filtering while the radius is changing, so that only
+# the latest of rapid successive radii is computed
+MEDIAN_COALESCE_WINDOW = _env_float("LUNGAIR_MEDIAN_COALESCE_MS", 50) / 1000
+# Largest size of the low-resolution median filter preview, per axis
+MEDIAN_PREVIEW_SIZE = _env_int("LUNGAIR_MEDIAN_PREVIEW_SIZE", 256)
+
+SEG_MAX_BATCH_SIZE = _env_int("LUNGAIR_SEG_MAX_BATCH_SIZE", 4)
+SEG_BATCH_WINDOW = _env_float("LUNGAIR_SEG_BATCH_WINDOW_MS", 20) / 1000
+# Images of a segmentLungsBatch request fetched, segmented or uploaded at a time
+SEG_BATCH_IN_FLIGHT = _env_int("LUNGAIR_SEG_BATCH_IN_FLIGHT", 2 * SEG_MAX_BATCH_SIZE * SEG_WORKERS)
+
+CACHE_MAX_BYTES = _env_int("LUNGAIR_CACHE_MAX_MB", 512) * 2**20
+CACHE_DIR = os.environ.get("LUNGAIR_CACHE_DIR")
+CACHE_MAX_DISK_BYTES = _env_int("LUNGAIR_CACHE_MAX_DISK_MB", 4096) * 2**20
+
+SHARED_IMAGE_DIR = os.environ.get("LUNGAIR_SHM_DIR") or (
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+
+# Prometheus-style metrics at http://<host>:<port>/metrics; 0 disables the endpoint
+METRICS_PORT = _env_int("LUNGAIR_METRICS_PORT", 0)
+# Print a summary of the stage timings every so many seconds; 0 disables it
+METRICS_LOG_INTERVAL = _env_float("LUNGAIR_METRICS_LOG_INTERVAL_S", 0)
+# Fraction of worker calls to profile, with "cprofile" or "torch"
+PROFILE_SAMPLE_RATE = _env_float("LUNGAIR_PROFILE_SAMPLE_RATE", 0)
+PROFILER = os.environ.get("LUNGAIR_PROFILER", "cprofile")
+PROFILE_DIR = os.environ.get("LUNGAIR_PROFILE_DIR") or os.path.join(
+    tempfile.gettempdir(), "lungair-profiles"
+)
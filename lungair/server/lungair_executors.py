@@ -0,0 +1,148 @@
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from lungair_config import available_cpus
+
+## Execution backends ##
+# Work can run in a process pool (default), in a thread pool, which relies on
+# ITK and torch releasing the GIL in their native code, or inline on the event
+# loop thread, which is mostly useful for debugging.
+
+
+class InlineExecutor(Executor):
+    """Runs each call synchronously in the calling thread."""
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+
+def set_worker_threads(threads: int):
+    """Limit the native threads used by ITK and torch in this worker."""
+    import itk
+
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+    itk.MultiThreaderBase.SetGlobalMaximumNumberOfThreads(threads)
+    if "torch" in sys.modules:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+def pin_worker(slot_counter, first_slot: int, workers: int, threads: int):
+    """Pin this worker process to its own set of `threads` CPUs.
+
+    Workers take the next slot of `slot_counter`. Slots of different pools are
+    disjoint when their `first_slot`s are. Nothing is pinned if there are not
+    enough CPUs.
+    """
+    with slot_counter.get_lock():
+        slot = first_slot + slot_counter.value % workers
+        slot_counter.value += 1
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return None
+    cores = cpus[slot * threads : (slot + 1) * threads]
+    if len(cores) < threads:
+        return None
+    os.sched_setaffinity(0, cores)
+    return cores
+
+
+def worker_info() -> dict:
+    """Identify the calling worker, for readiness reports."""
+    try:
+        cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = None
+    return {"pid": os.getpid(), "thread": threading.current_thread().name, "cores": cores}
+
+
+def init_worker(threads: int, initializer=None, initargs=(), pinning=None, ready_queue=None):
+    if pinning is not None:
+        pin_worker(*pinning, threads)
+    set_worker_threads(threads)
+    if initializer is not None:
+        initializer(*initargs)
+    if ready_queue is not None:
+        ready_queue.put(worker_info())
+
+
+def _report_ready(initializer, initargs, on_ready):
+    """Initializer for thread and inline workers, which report readiness directly."""
+    if initializer is not None:
+        initializer(*initargs)
+    if on_ready is not None:
+        on_ready(worker_info())
+
+
+def _forward_ready(ready_queue, on_ready):
+    while True:
+        on_ready(ready_queue.get())
+
+
+def start_workers(executor: Executor, workers: int):
+    """Start all workers of a pool now rather than on first use.
+
+    Pools start a worker when a call is submitted and no worker is idle, so
+    submitting one empty call per worker starts them all.
+    """
+    for _ in range(workers):
+        executor.submit(int)
+
+
+def create_executor(
+    kind: str, workers: int, threads: int, initializer=None, initargs=(), first_slot=None, on_ready=None
+):
+    """Create an executor of the given kind ("process", "thread" or "inline").
+
+    Each worker limits ITK and torch to `threads` native threads per call. Thread
+    workers share one process, so the limit is applied once for all of them.
+    Process workers are pinned to CPU slots `first_slot` to `first_slot + workers`
+    of `threads` CPUs each, unless `first_slot` is None. `on_ready` is called in
+    the server process with the `worker_info` of each worker once its
+    initializer has run.
+
+    A process pool does not replace a worker that dies: the pool is broken and
+    every later call raises BrokenProcessPool, so the caller has to create a
+    new executor, whose workers take the same CPU slots.
+    """
+    if kind == "process":
+        pinning = None
+        if first_slot is not None and (first_slot + workers) * threads <= available_cpus():
+            pinning = (multiprocessing.Value("i", 0), first_slot, workers)
+        ready_queue = None
+        if on_ready is not None:
+            ready_queue = multiprocessing.SimpleQueue()
+            threading.Thread(
+                target=_forward_ready, args=(ready_queue, on_ready), name="lungair-workers-ready", daemon=True
+            ).start()
+        return ProcessPoolExecutor(
+            workers,
+            initializer=init_worker,
+            initargs=(threads, initializer, initargs, pinning, ready_queue),
+        )
+    if kind == "thread":
+        set_worker_threads(threads)
+        return ThreadPoolExecutor(
+            workers,
+            thread_name_prefix="lungair",
+            initializer=_report_ready,
+            initargs=(initializer, initargs, on_ready),
+        )
+    if kind == "inline":
+        set_worker_threads(threads)
+        return InlineExecutor(initializer=_report_ready, initargs=(initializer, initargs, on_ready))
+    raise ValueError(f"Unknown executor kind: {kind}")
@@ -0,0 +1,203 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from lungair_transport import create_shared_file
+
+## Jobs ##
+# Every long-running request is tracked as a job with an ID, a progress value
+# and a cancel flag. The flag and progress live in a tiny memory-mapped file
+# shared with the pool workers, so a superseded job can stop its worker
+# promptly instead of running to completion.
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobChannel:
+    """Cancel flag and progress value shared between the event loop and a worker."""
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = create_shared_file(2 * np.dtype(np.float32).itemsize, prefix="lungair-job-", suffix="")
+        self.path = path
+        self._values = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._values = None
+
+    def _get_values(self):
+        if self._values is None:
+            self._values = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(2,))
+        return self._values
+
+    @property
+    def cancelled(self) -> bool:
+        try:
+            return bool(self._get_values()[0])
+        except FileNotFoundError:
+            # the job was finished and released by the event loop
+            return True
+
+    def cancel(self):
+        try:
+            self._get_values()[0] = 1
+        except FileNotFoundError:
+            pass
+
+    @property
+    def progress(self) -> float:
+        try:
+            return float(self._get_values()[1])
+        except FileNotFoundError:
+            return 0.0
+
+    @progress.setter
+    def progress(self, value: float):
+        try:
+            self._get_values()[1] = value
+        except FileNotFoundError:
+            pass
+
+    def check(self):
+        """Raise JobCancelled if the job has been cancelled. Call between work items."""
+        if self.cancelled:
+            raise JobCancelled()
+
+    def release(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+@dataclass
+class Job:
+    operation: str
+    image_id: str
+    params: dict = field(default_factory=dict)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    state: str = "queued"
+    error: str = None
+    created: float = field(default_factory=time.time)
+    finished: float = None
+    channel: JobChannel = field(default_factory=JobChannel, repr=False)
+    task: asyncio.Task = field(default=None, repr=False)
+    _progress: float = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "cancelled", "failed")
+
+    @property
+    def progress(self) -> float:
+        if self.state == "done":
+            return 1.0
+        if self.done:
+            return self._progress
+        return max(self._progress, self.channel.progress)
+
+    def report(self, progress: float):
+        self._progress = progress
+
+    def cancel(self):
+        if self.done:
+            return
+        self.state = "cancelled"
+        self.channel.cancel()
+        if self.task is not None:
+            self.task.cancel()
+
+    def as_dict(self):
+        return {
+            "job_id": self.id,
+            "operation": self.operation,
+            "image_id": self.image_id,
+            "params": self.params,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+        }
+
+
+class JobRegistry:
+    """Keeps all jobs by ID, remembering a bounded number of finished ones."""
+
+    def __init__(self, max_finished: int = 256):
+        self.max_finished = max_finished
+        self._jobs = OrderedDict()
+
+    def get(self, job_id: str) -> Job:
+        return self._jobs.get(job_id)
+
+    def active(self):
+        return [job for job in self._jobs.values() if not job.done]
+
+    def start(self, active_jobs: dict, job: Job):
+        """Register `job` as running, superseding the active job with the same scope.
+
+        `active_jobs` is the per-session map from (operation, image_id) to the
+        current job.
+        """
+        scope = (job.operation, job.image_id)
+        previous = active_jobs.get(scope)
+        if previous is not None and not previous.done:
+            print(f"Job {job.id} supersedes {previous.id} ({job.operation} on {job.image_id}).")
+            previous.cancel()
+        active_jobs[scope] = job
+        self._jobs[job.id] = job
+        job.state = "running"
+
+    def finish(self, active_jobs: dict, job: Job, state: str, error: str = None):
+        if not job.done:
+            job.state = state
+            job.error = error
+        job._progress = max(job._progress, job.channel.progress)
+        job.finished = time.time()
+        job.channel.release()
+        # Finished jobs only keep their status: the task would keep the result
+        # (or the exception and its frames) alive until the job is trimmed.
+        job.task = None
+        scope = (job.operation, job.image_id)
+        if active_jobs.get(scope) is job:
+            del active_jobs[scope]
+        self._trim()
+
+    async def run(self, active_jobs: dict, job: Job, coro_factory):
+        """Run `coro_factory(job)` as `job`.
+
+        Returns the coroutine result, or None if the job was cancelled by a
+        newer request in the meantime.
+        """
+        self.start(active_jobs, job)
+        job.task = asyncio.ensure_future(coro_factory(job))
+        try:
+            result = await job.task
+        except (asyncio.CancelledError, JobCancelled):
+            if job.state != "cancelled":
+                # the request itself went away: stop the work too
+                job.cancel()
+                self.finish(active_jobs, job, "cancelled")
+                raise
+            self.finish(active_jobs, job, "cancelled")
+            return None
+        except Exception as exc:
+            self.finish(active_jobs, job, "failed", str(exc))
+            raise
+        self.finish(active_jobs, job, "done")
+        return result
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -1,8 +1,20 @@
+import time
+
+# Startup is timed from the first import of this module.
+import_started = time.perf_counter()
+
 import asyncio
+import atexit
+import functools
+import inspect
+import os
+import random
+import weakref
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
-from concurrent.futures import ProcessPoolExecutor
 
-import itk
+import numpy as np
 
 from volview_server import (
     VolViewApi,
@@ -10,12 +22,35 @@ from volview_server import (
     get_current_session,
 )
 
-from volview_server.transformers import (
-    convert_itk_to_vtkjs_image,
-    convert_vtkjs_to_itk_image,
+import lungair_config as config
+from lungair_batching import MicroBatcher
+from lungair_cache import ResultCache, image_digest, result_key
+from lungair_executors import create_executor, start_workers
+from lungair_jobs import Job, JobCancelled, JobRegistry
+from lungair_metrics import (
+    MetricsRegistry,
+    call_with_metrics,
+    start_metrics_log,
+    start_metrics_server,
+    startup_report,
+)
+from lungair_registry import DerivedImageRegistry, MemoryBudget
+from lungair_transport import (
+    SharedImage,
+    share_image,
+    allocate_shared_image,
+    release_shared_image,
+    subsample_shared_image,
+    take_shared_image,
+)
+from lungair_workers import (
+    do_lung_segmentation_batch,
+    do_lung_segmentation_slices,
+    do_lung_segmentation_sliding_window,
+    do_median_filter,
+    init_median_worker,
+    init_segmentation_worker,
 )
-
-from lungair_seg_inference import run_lungair_seg_inference
 
 ## Link to app ##
 
@@ -27,47 +62,494 @@ volview = VolViewApi()
 # copied from
 # https://github.com/Kitware/VolView/blob/411e5a891bfb520647ab3f97cac6edfcca930a65/server/examples/example_api.py
 
-process_pool = ProcessPoolExecutor(4)
+SEG_MODEL_CHECKPOINT = config.SEG_MODEL_CHECKPOINT
+
+# Workers are started at boot rather than by the first request, and report
+# their pid and CPUs once their initializer has run.
+started = time.time()
+pool_ready = {"median": [], "segmentation": []}
+
+
+def on_worker_ready(name, workers):
+    def on_ready(info):
+        pool_ready[name].append(info)
+        print(f"{name.capitalize()} worker {info['pid']} ready on CPUs {info['cores']}.")
+        if len(pool_ready[name]) == workers:
+            print(f"All {workers} {name} workers ready after {time.time() - started:.1f} s.")
+
+    return on_ready
+
+
+# Median filtering and segmentation get their own workers, so that long
+# segmentations cannot starve interactive median filtering.
+# Each segmentation worker loads the model once at startup and runs it on a
+# blank image to keep it warm. With LUNGAIR_PIN_WORKERS, segmentation workers
+# get the first CPUs and median filter workers the next ones.
+# The pools are recreated from the same arguments if one of their workers dies.
+pool_factories = {
+    "segmentation": functools.partial(
+        create_executor,
+        config.EXECUTOR,
+        config.SEG_WORKERS,
+        config.THREADS_PER_WORKER,
+        initializer=init_segmentation_worker,
+        initargs=(SEG_MODEL_CHECKPOINT,),
+        first_slot=0 if config.PIN_WORKERS else None,
+        on_ready=on_worker_ready("segmentation", config.SEG_WORKERS),
+    ),
+    "median": functools.partial(
+        create_executor,
+        config.EXECUTOR,
+        config.MEDIAN_WORKERS,
+        config.THREADS_PER_WORKER,
+        initializer=init_median_worker,
+        first_slot=config.SEG_WORKERS if config.PIN_WORKERS else None,
+        on_ready=on_worker_ready("median", config.MEDIAN_WORKERS),
+    ),
+}
+segmentation_pool = pool_factories["segmentation"]()
+median_pool = pool_factories["median"]()
+print(
+    f"Using {config.EXECUTOR} executors: {config.MEDIAN_WORKERS} median filter and "
+    f"{config.SEG_WORKERS} segmentation workers, {config.THREADS_PER_WORKER} threads each."
+)
+
+# Results are shared across sessions, keyed by input content and parameters.
+result_cache = ResultCache(
+    max_bytes=config.CACHE_MAX_BYTES,
+    disk_dir=config.CACHE_DIR,
+    max_disk_bytes=config.CACHE_MAX_DISK_BYTES,
+)
+
+# Long-running requests, by job ID. A new request for the same operation and
+# base image in a session supersedes the one still in flight.
+jobs = JobRegistry()
+
+
+## Metrics ##
+
+metrics = MetricsRegistry()
+metrics.describe("lungair_request_seconds", "Duration of server method calls")
+metrics.describe("lungair_stage_seconds", "Duration of each stage of a request")
+metrics.describe("lungair_bytes_transferred_total", "Image bytes passed to and from the workers")
+metrics.describe("lungair_worker_busy_seconds_total", "Time the workers of each pool spent on calls")
+metrics.describe("lungair_pool_restarts_total", "Pools recreated after one of their workers died")
+
+pools = {
+    "median": (median_pool, config.MEDIAN_WORKERS),
+    "segmentation": (segmentation_pool, config.SEG_WORKERS),
+}
+pool_in_flight = {name: 0 for name in pools}
+
+for pool_name, (pool, workers) in pools.items():
+    start_workers(pool, workers)
+
+
+def pool_gauges(value):
+    return lambda: [({"pool": name}, value(name, workers)) for name, (_, workers) in pools.items()]
+
+
+def worker_utilization(name, workers):
+    busy = metrics.counter_value("lungair_worker_busy_seconds_total", pool=name)
+    return busy / (workers * (time.time() - started))
+
+
+metrics.gauge_function("lungair_pool_workers", pool_gauges(lambda name, workers: workers))
+metrics.gauge_function(
+    "lungair_pool_ready_workers",
+    pool_gauges(lambda name, workers: min(workers, len(pool_ready[name]))),
+    "Workers of each pool that finished starting up",
+)
+metrics.gauge_function(
+    "lungair_pool_in_flight",
+    pool_gauges(lambda name, workers: pool_in_flight[name]),
+    "Calls submitted to each pool and not finished yet",
+)
+metrics.gauge_function(
+    "lungair_pool_queue_depth",
+    pool_gauges(lambda name, workers: max(0, pool_in_flight[name] - workers)),
+    "Calls waiting for a free worker",
+)
+metrics.gauge_function(
+    "lungair_worker_utilization",
+    pool_gauges(worker_utilization),
+    "Fraction of the worker time spent on calls since startup",
+)
+metrics.gauge_function("lungair_cache_entries", lambda: len(result_cache))
+metrics.gauge_function("lungair_cache_bytes", lambda: result_cache.nbytes)
+metrics.gauge_function(
+    "lungair_cache_lookups",
+    lambda: [({"result": result}, count) for result, count in result_cache.stats.as_dict().items()],
+)
+
+if config.METRICS_PORT:
+    start_metrics_server(metrics, config.METRICS_PORT)
+if config.METRICS_LOG_INTERVAL:
+    start_metrics_log(metrics, config.METRICS_LOG_INTERVAL)
+
+
+def timed_request(operation: str):
+    """Record the duration of a server method, including async generators."""
+
+    def decorate(fn):
+        if inspect.isasyncgenfunction(fn):
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with metrics.timer("lungair_request_seconds", operation=operation):
+                    async for item in fn(*args, **kwargs):
+                        yield item
+
+        else:
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with metrics.timer("lungair_request_seconds", operation=operation):
+                    return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def stage_timer(operation: str, stage: str):
+    return metrics.timer("lungair_stage_seconds", operation=operation, stage=stage)
+
+
+async def run_in_pool(pool_name: str, operation: str, fn, *args):
+    """Run `fn(*args)` in a worker pool, recording its queueing and worker stage timings.
+
+    A sampled fraction of the calls is profiled, see `LUNGAIR_PROFILE_SAMPLE_RATE`.
+    """
+    pool, _ = pools[pool_name]
+    profile = None
+    if config.PROFILE_SAMPLE_RATE and random.random() < config.PROFILE_SAMPLE_RATE:
+        profile = (config.PROFILER, config.PROFILE_DIR)
+
+    loop = asyncio.get_event_loop()
+    pool_in_flight[pool_name] += 1
+    try:
+        result, stage_times = await loop.run_in_executor(
+            pool, call_with_metrics, time.time(), profile, fn, *args
+        )
+    except BrokenProcessPool:
+        # The call that crashed the worker is not retried, but later calls get
+        # a new pool.
+        replace_broken_pool(pool_name, pool)
+        raise
+    finally:
+        pool_in_flight[pool_name] -= 1
+
+    metrics.merge_stage_times(stage_times, operation=operation)
+    busy = sum(seconds for stage, seconds in stage_times if stage == "worker_busy")
+    metrics.inc("lungair_worker_busy_seconds_total", busy, pool=pool_name)
+    return result
+
+
+def replace_broken_pool(pool_name: str, broken):
+    """Replace a process pool whose worker died, which would fail every later call."""
+    pool, workers = pools[pool_name]
+    if pool is not broken:
+        # already replaced after another call that was in flight
+        return
+    print(f"A {pool_name} worker died; restarting the {pool_name} workers.")
+    metrics.inc("lungair_pool_restarts_total", pool=pool_name)
+    broken.shutdown(wait=False)
+    pool_ready[pool_name] = []
+    pool = pool_factories[pool_name]()
+    pools[pool_name] = (pool, workers)
+    start_workers(pool, workers)
+
+
+def share_input(img, operation: str):
+    with stage_timer(operation, "share_input"):
+        shared_img = share_image(img)
+    metrics.inc("lungair_bytes_transferred_total", shared_img.nbytes, direction="to_worker")
+    return shared_img
+
+
+def take_output(shared_output, operation: str):
+    metrics.inc("lungair_bytes_transferred_total", shared_output.nbytes, direction="from_worker")
+    with stage_timer(operation, "take_output"):
+        return take_shared_image(shared_output)
+
+
+@dataclass
+class ResidentImage:
+    """A base image kept on the server between the requests of a session.
+
+    It is fetched from the client and hashed once, shared with the workers on
+    first use, and subsampled for median filter previews on first use. Worker
+    calls reading its shared memory hold a reference to it, and an evicted
+    image keeps its shared memory until the last of them finishes.
+    """
+
+    image: object
+    digest: str
+    shared: SharedImage = None
+    # (SharedImage, step along each NumPy axis)
+    preview: tuple = None
+    # number of jobs using the image
+    users: int = 0
+    evicted: bool = False
+
+    @property
+    def nbytes(self) -> int:
+        import itk
+
+        nbytes = itk.array_view_from_image(self.image).nbytes
+        if self.shared is not None:
+            nbytes += self.shared.nbytes
+        if self.preview is not None:
+            nbytes += self.preview[0].nbytes
+        return nbytes
+
+    def acquire(self):
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.users:
+            return
+        if self.evicted:
+            self._free()
+        else:
+            # it may have been kept over the budget while in use
+            resident_budget.trim()
+
+    def evict(self):
+        """Drop the image from the server, once no job uses it anymore."""
+        self.evicted = True
+        resident_budget.discharge(id(self))
+        if not self.users:
+            self._free()
+
+    def _free(self):
+        if self.shared is not None:
+            release_shared_image(self.shared)
+        if self.preview is not None:
+            release_shared_image(self.preview[0])
+        self.shared = self.preview = None
+
+    def __del__(self):
+        self._free()
+
+
+def new_derived_registry():
+    return DerivedImageRegistry(config.SESSION_MAX_DERIVED, config.SESSION_DERIVED_TTL)
 
 
 @dataclass
 class ClientState:
-    image_id_map: dict = field(init=False, default_factory=dict)
-    blurred_ids: set = field(init=False, default_factory=set)
+    # blurred images, label maps and probability maps of the base images
+    derived: DerivedImageRegistry = field(init=False, default_factory=new_derived_registry)
+    # (operation, base image ID) -> running Job
+    active_jobs: dict = field(init=False, default_factory=dict)
+    # base image ID -> ResidentImage, least recently used first
+    resident_images: OrderedDict = field(init=False, default_factory=OrderedDict)
 
 
-def do_median_filter(serialized_img, radius):
-    img = convert_vtkjs_to_itk_image(serialized_img)
-    ImageType = type(img)
+async def run_median_filter_process(shared_img, radius, channel=None):
+    shared_output = await run_in_pool(
+        "median", "medianFilter", do_median_filter, shared_img, radius, channel
+    )
+    return take_output(shared_output, "medianFilter")
+
 
-    median_filter = itk.MedianImageFilter[ImageType, ImageType].New()
-    median_filter.SetInput(img)
-    median_filter.SetRadius(radius)
-    median_filter.Update()
+## Resident images ##
+# Interactive median filtering re-runs the filter on the same base image for
+# every radius. The base image is kept on the server for the session, so it is
+# fetched from the client, hashed and copied to shared memory only once.
+# Resident images of all sessions share one memory budget.
 
-    output = median_filter.GetOutput()
-    return convert_itk_to_vtkjs_image(output)
+resident_budget = MemoryBudget(config.RESIDENT_MAX_BYTES)
+metrics.gauge_function("lungair_resident_images", lambda: len(resident_budget))
+metrics.gauge_function(
+    "lungair_resident_bytes",
+    lambda: resident_budget.nbytes,
+    "Bytes of base images kept on the server for all sessions",
+)
+metrics.gauge_function("lungair_resident_evictions", lambda: resident_budget.evictions)
+# remove the shared memory files of the resident images left at exit
+atexit.register(resident_budget.clear)
 
 
-async def run_median_filter_process(img, radius: int):
-    serialized_img = convert_itk_to_vtkjs_image(img)
+def charge_resident(state: ClientState, image_id: str, resident: ResidentImage):
+    """Charge the current size of a resident image to the server-wide budget."""
+    state_ref = weakref.ref(state)
+
+    def evict():
+        state = state_ref()
+        if state is not None and state.resident_images.get(image_id) is resident:
+            del state.resident_images[image_id]
+        resident.evict()
+
+    resident_budget.charge(id(resident), resident.nbytes, evict, in_use=lambda: resident.users > 0)
+
+
+async def get_resident_image(store, state: ClientState, image_id: str, operation: str) -> ResidentImage:
+    """Return the resident copy of image `image_id`, fetching it on first use."""
+    resident = state.resident_images.get(image_id)
+    if resident is not None:
+        state.resident_images.move_to_end(image_id)
+        resident_budget.touch(id(resident))
+        metrics.inc("lungair_resident_image_lookups_total", result="hit")
+        return resident
+    metrics.inc("lungair_resident_image_lookups_total", result="miss")
+
+    with stage_timer(operation, "fetch_image"):
+        img = await store.dataIndex[image_id]
     loop = asyncio.get_event_loop()
-    serialized_output = await loop.run_in_executor(
-        process_pool, do_median_filter, serialized_img, radius
-    )
-    return convert_vtkjs_to_itk_image(serialized_output)
+    with stage_timer(operation, "hash"):
+        digest = await loop.run_in_executor(None, image_digest, img)
+    resident = ResidentImage(img, digest)
+    if config.RESIDENT_IMAGES > 0:
+        state.resident_images[image_id] = resident
+        while len(state.resident_images) > config.RESIDENT_IMAGES:
+            _, evicted = state.resident_images.popitem(last=False)
+            evicted.evict()
+        charge_resident(state, image_id, resident)
+    return resident
 
 
-def associate_images(state, image_id, blurred_id):
-    state.blurred_ids.add(blurred_id)
-    state.image_id_map[image_id] = blurred_id
-    state.image_id_map[blurred_id] = image_id
+def resident_shared_image(state: ClientState, image_id: str, resident: ResidentImage, operation: str) -> SharedImage:
+    if resident.shared is None:
+        resident.shared = share_input(resident.image, operation)
+        if state.resident_images.get(image_id) is resident:
+            charge_resident(state, image_id, resident)
+    return resident.shared
+
+
+def resident_preview(state: ClientState, image_id: str, resident: ResidentImage, operation: str):
+    """Return the subsampled preview of a resident image and its steps along the NumPy axes."""
+    if resident.preview is None:
+        shared = resident_shared_image(state, image_id, resident, operation)
+        with stage_timer(operation, "subsample"):
+            resident.preview = subsample_shared_image(shared, config.MEDIAN_PREVIEW_SIZE)
+        if state.resident_images.get(image_id) is resident:
+            charge_resident(state, image_id, resident)
+    return resident.preview
+
+
+def drop_resident_image(state: ClientState, img_id: str):
+    resident = state.resident_images.pop(img_id, None)
+    if resident is not None:
+        resident.evict()
+
+
+@volview.expose("imageUpdated")
+def image_updated(img_id):
+    """Drop the server's copy of an image after the client changed it."""
+    state = get_current_session(default_factory=ClientState)
+    drop_resident_image(state, img_id)
+
+
+def forget_closed_images(state: ClientState, client_ids):
+    """Forget the derived and resident images of the session missing from `client_ids`."""
+    client_ids = set(client_ids)
+    state.derived.prune(client_ids)
+    for img_id in [img_id for img_id in state.resident_images if img_id not in client_ids]:
+        print(f"Dropping resident image {img_id}, which the client closed.")
+        drop_resident_image(state, img_id)
 
 
 def get_base_image(state: ClientState, img_id: str) -> str:
-    if img_id in state.blurred_ids:
-        return state.image_id_map[img_id]
-    return img_id
+    return state.derived.base_of(img_id)
+
+
+async def derived_image_id(store, state: ClientState, base_image_id: str, operation: str, **params) -> str:
+    """Return the ID of the image derived from `base_image_id` by `operation`, if
+    the client still has it.
+
+    The client's image IDs are fetched in one call, which also forgets all
+    derived and resident images of the session that the client no longer has.
+    Base images are only ever changed by the client, so this is what keeps the
+    resident images valid without relying on `imageUpdated`.
+    """
+    image_id = state.derived.get(base_image_id, operation, **params)
+    if image_id is None and not state.resident_images:
+        return None
+    forget_closed_images(state, await store.idList)
+    return state.derived.get(base_image_id, operation, **params)
+
+
+async def upload_derived(store, state: ClientState, base_image_id: str, operation: str, name: str, output, **params) -> str:
+    """Update the image derived from `base_image_id` by `operation` with `output`,
+    or add it to the client as `name` if there is none yet. Returns its ID."""
+    image_id = await derived_image_id(store, state, base_image_id, operation, **params)
+    if image_id:
+        print(f"Updating existing {operation} image ID: {image_id}.")
+        await store.updateData(image_id, output)
+    else:
+        image_id = await store.addVTKImageData(name, output)
+        print(f"New {operation} image ID: {image_id}.")
+        # Requests on the derived image run on its base image.
+        state.derived.add(base_image_id, operation, image_id, **params)
+    return image_id
+
+
+@volview.expose("sessionStats")
+def session_stats():
+    """Report the derived and resident images of this session and the server-wide budget."""
+    state = get_current_session(default_factory=ClientState)
+    return {
+        "derived_images": state.derived.as_list(),
+        "resident_images": len(state.resident_images),
+        "resident_bytes": sum(resident.nbytes for resident in state.resident_images.values()),
+        "server_resident_bytes": resident_budget.nbytes,
+        "server_resident_max_bytes": resident_budget.max_bytes,
+    }
+
+
+def checkpoint_version(model_checkpoint: str) -> str:
+    """Identify the model that produces results, including the inference engine."""
+    try:
+        stat = os.stat(model_checkpoint)
+    except FileNotFoundError:
+        return "missing"
+    engine = config.SEG_ENGINE + ("-int8" if config.SEG_QUANTIZE else "")
+    return f"{os.path.abspath(model_checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}:{engine}"
+
+
+async def lookup_cached(img, operation: str, digest: str = None, **params):
+    """Return the cache key for `operation` on `img` and the cached output, if any.
+
+    `digest` is the `image_digest` of `img`, if already known.
+    """
+    loop = asyncio.get_event_loop()
+    # hashing and disk lookups release the GIL, so keep them off the event loop
+    with stage_timer(operation, "cache_lookup"):
+        if digest is None:
+            digest = await loop.run_in_executor(None, image_digest, img)
+        key = result_key(digest, operation, **params)
+        output = await loop.run_in_executor(None, result_cache.get, key)
+    if output is not None:
+        print(f"Using cached {operation} result.")
+    return key, output
+
+
+async def store_cached(key: str, output, operation: str):
+    loop = asyncio.get_event_loop()
+    with stage_timer(operation, "cache_store"):
+        await loop.run_in_executor(None, result_cache.put, key, output)
+
+
+async def run_cached(img, operation: str, compute, **params):
+    """Return the cached result of `operation` on `img`, computing it on a miss."""
+    key, output = await lookup_cached(img, operation, **params)
+    if output is None:
+        output = await compute()
+        await store_cached(key, output, operation)
+    return output
+
+
+@volview.expose("cacheStats")
+def cache_stats():
+    return {
+        "entries": len(result_cache),
+        "bytes": result_cache.nbytes,
+        **result_cache.stats.as_dict(),
+    }
 
 
 async def show_image(img_id: str):
@@ -75,8 +557,99 @@ async def show_image(img_id: str):
     await store.setPrimarySelection({"type": "image", "dataID": img_id})
 
 
+@volview.expose("metrics")
+def metrics_text():
+    """Return all metrics in the Prometheus text format."""
+    return metrics.render()
+
+
+@volview.expose("serverStatus")
+def server_status():
+    """Report whether the workers of each pool are started and warmed up."""
+    return {
+        name: {
+            "workers": workers,
+            "ready": min(workers, len(pool_ready[name])),
+            "started_workers": list(pool_ready[name]),
+        }
+        for name, (_, workers) in pools.items()
+    }
+
+
+@volview.expose("jobStatus")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    return job.as_dict() if job else None
+
+
+@volview.expose("listJobs")
+def list_jobs():
+    state = get_current_session(default_factory=ClientState)
+    return [job.as_dict() for job in state.active_jobs.values()]
+
+
+@volview.expose("cancelJob")
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return None
+    job.cancel()
+    return job.as_dict()
+
+
+async def upload_blurred(store, state: ClientState, base_image_id: str, output):
+    """Show `output` as the blurred image of `base_image_id`, adding it on first use."""
+    with stage_timer("medianFilter", "upload"):
+        blurred_id = await upload_derived(store, state, base_image_id, "medianFilter", "Blurred image", output)
+
+    await show_image(blurred_id)
+
+
+async def run_resident_median_filter(resident: ResidentImage, shared_img, radius, channel):
+    """Median filter the shared memory of a resident image.
+
+    The image is held until the worker is done reading it, which may be
+    after the request was cancelled.
+    """
+    resident.acquire()
+    task = asyncio.ensure_future(run_median_filter_process(shared_img, radius, channel))
+
+    def done(task):
+        if not task.cancelled():
+            task.exception()  # retrieved here if the request was cancelled first
+        resident.release()
+
+    task.add_done_callback(done)
+    return await asyncio.shield(task)
+
+
+async def upload_median_preview(store, state: ClientState, base_image_id: str, resident, radius, channel):
+    """Filter and show a low-resolution copy of the image, with the radius scaled to match."""
+    shared_preview, steps = resident_preview(state, base_image_id, resident, "medianFilter")
+    if all(step == 1 for step in steps):
+        return  # the image is small enough to filter at full resolution right away
+    # ITK axes are in the reverse order of the NumPy axes
+    radii = radius if isinstance(radius, (list, tuple)) else [radius] * len(steps)
+    preview_radius = [max(1, round(r / step)) for r, step in zip(radii, reversed(steps))]
+    output = await run_resident_median_filter(resident, shared_preview, preview_radius, channel)
+    await upload_blurred(store, state, base_image_id, output)
+
+
 @volview.expose("medianFilter")
-async def median_filter(img_id, radius):
+@timed_request("medianFilter")
+async def median_filter(img_id, radius, options=None):
+    """Median filter an image and show the result as its blurred image.
+
+    Options:
+      preview: first show the filtered low-resolution copy of the image, at
+        most LUNGAIR_MEDIAN_PREVIEW_SIZE pixels along each axis, then the
+        full-resolution result.
+    """
+    options = dict(options or {})
+    preview = bool(options.pop("preview", False))
+    if options:
+        raise ValueError(f"Unknown median filter options: {', '.join(options)}")
+
     print(f"Started median filter on {img_id} with radius {radius}...")
     store = get_current_client_store("images")
     state = get_current_session(default_factory=ClientState)
@@ -85,76 +658,541 @@ async def median_filter(img_id, radius):
     # blurred image, we instead assume we are re-running
     # the blur operation on the original image.
     base_image_id = get_base_image(state, img_id)
-    img = await store.dataIndex[base_image_id]
 
-    # we need to run the median filter in a subprocess,
-    # since itk blocks the GIL.
-    output = await run_median_filter_process(img, radius)
+    # A request arriving while the previous radius is still being filtered
+    # is part of a radius scrub: wait briefly, so that requests superseded in
+    # the meantime never reach a worker.
+    previous = state.active_jobs.get(("medianFilter", base_image_id))
+    coalesce = previous is not None and not previous.done
+
+    async def run(job):
+        if coalesce and config.MEDIAN_COALESCE_WINDOW:
+            await asyncio.sleep(config.MEDIAN_COALESCE_WINDOW)
+        resident = await get_resident_image(store, state, base_image_id, "medianFilter")
+        key, output = await lookup_cached(
+            resident.image, "medianFilter", digest=resident.digest, radius=radius
+        )
+        if output is not None:
+            return output
+        if preview:
+            await upload_median_preview(store, state, base_image_id, resident, radius, job.channel)
+        # we need to run the median filter in a subprocess,
+        # since itk blocks the GIL.
+        output = await run_resident_median_filter(
+            resident, resident_shared_image(state, base_image_id, resident, "medianFilter"), radius, job.channel
+        )
+        await store_cached(key, output, "medianFilter")
+        return output
+
+    # A newer radius for the same image cancels this request.
+    job = Job("medianFilter", base_image_id, {"radius": radius})
+    output = await jobs.run(state.active_jobs, job, run)
+    if job.state == "cancelled":
+        print(f"Median filter on {img_id} with radius {radius} was superseded.")
+        return job.as_dict()
     print(f"Completed median filter on {img_id} with radius {radius}.")
 
-    blurred_id = state.image_id_map.get(base_image_id)
-    if not blurred_id:
-        blurred_id = await store.addVTKImageData("Blurred image", output)
-        # Associate the blurred image ID with the base image ID.
-        associate_images(state, base_image_id, blurred_id)
+    await upload_blurred(store, state, base_image_id, output)
+    return job.as_dict()
+
+async def run_lung_segmentation_batch_process(items):
+    shared_imgs = [share_input(img, "segmentLungs") for img, _, _ in items]
+    channels = [channel for _, channel, _ in items]
+    probabilities = [probability for _, _, probability in items]
+    try:
+        shared_outputs = await run_in_pool(
+            "segmentation",
+            "segmentLungs",
+            do_lung_segmentation_batch,
+            shared_imgs,
+            channels,
+            probabilities,
+        )
+    finally:
+        for shared_img in shared_imgs:
+            release_shared_image(shared_img)
+
+    results = []
+    for output in shared_outputs:
+        if output is None:
+            results.append(None)
+        elif isinstance(output, tuple):
+            results.append(tuple(take_output(shared, "segmentLungs") for shared in output))
+        else:
+            results.append(take_output(output, "segmentLungs"))
+    return results
+
+# Segmentation requests from all sessions that arrive within a short window
+# are stacked into a single forward pass.
+segmentation_batcher = MicroBatcher(
+    run_lung_segmentation_batch_process,
+    max_batch_size=config.SEG_MAX_BATCH_SIZE,
+    window=config.SEG_BATCH_WINDOW,
+)
+
+def check_segmentation_input(img):
+    """Raise ValueError if the 2D model cannot segment `img`.
+
+    Runs in the server process, so that a bad image is rejected before it
+    joins a micro-batch with other requests.
+    """
+    import itk
+
+    components = img.GetNumberOfComponentsPerPixel()
+    if components != 1:
+        raise ValueError(f"Expected a scalar input image, got {components} components per pixel")
+    array = itk.array_view_from_image(img)
+    if array.dtype.kind not in "uif":
+        raise ValueError(f"Unsupported input pixel type: {array.dtype}")
+    if array.squeeze().ndim != 2:
+        raise ValueError(f"Expected input image of dimension 2, got: {array.squeeze().ndim}")
+
+async def run_lung_segmentation_process(img, channel=None, probabilities=False):
+    """Segment `img` as part of a micro-batch.
+
+    Returns the label map, or a (label map, lung probability map) pair if
+    `probabilities` is set.
+    """
+    check_segmentation_input(img)
+    seg = await segmentation_batcher.submit((img, channel, probabilities))
+    if seg is None:
+        raise JobCancelled()
+    return seg
+
+async def run_lung_segmentation_sliding_window_process(img, window_options, channel=None):
+    check_segmentation_input(img)
+    shared_img = share_input(img, "segmentLungs")
+    try:
+        shared_output = await run_in_pool(
+            "segmentation",
+            "segmentLungs",
+            do_lung_segmentation_sliding_window,
+            shared_img,
+            window_options,
+            channel,
+        )
+    finally:
+        release_shared_image(shared_img)
+    return take_output(shared_output, "segmentLungs")
+
+def parse_segmentation_options(options):
+    """Validate the optional `segmentLungs` options.
+
+    Supported options:
+      mode: "resize" (default) runs the whole image resized to the model input
+        size; "sliding_window" runs tiles at native resolution.
+      roi_size, overlap, sw_batch_size: sliding window parameters.
+      probabilities: also upload the lung probability map (resize mode only).
+    """
+    options = dict(options or {})
+    mode = options.pop("mode", "resize")
+    probabilities = bool(options.pop("probabilities", False))
+    if probabilities and mode != "resize":
+        raise ValueError("probabilities are only available in resize mode")
+    if mode == "resize":
+        window_options = {}
+    elif mode == "sliding_window":
+        window_options = {
+            "roi_size": [int(size) for size in options.pop("roi_size", [512, 512])],
+            "overlap": float(options.pop("overlap", 0.25)),
+            "sw_batch_size": int(options.pop("sw_batch_size", 1)),
+        }
+        if len(window_options["roi_size"]) != 2:
+            raise ValueError("roi_size must have two values")
+        if not 0 <= window_options["overlap"] < 1:
+            raise ValueError("overlap must be in [0, 1)")
+        if window_options["sw_batch_size"] < 1:
+            raise ValueError("sw_batch_size must be at least 1")
     else:
-        await store.updateData(blurred_id, output)
+        raise ValueError(f"Unknown segmentation mode: {mode}")
+    if options:
+        raise ValueError(f"Unknown segmentation options: {', '.join(options)}")
+    return mode, window_options, probabilities
 
-    await show_image(blurred_id)
+@volview.expose("segmentationStats")
+def segmentation_stats():
+    return {
+        "queue_depth": segmentation_batcher.queue_depth,
+        "in_flight": segmentation_batcher.in_flight,
+        **segmentation_batcher.stats.as_dict(),
+    }
 
-def do_lung_segmentation(serialized_img):
-    itk_img = convert_vtkjs_to_itk_image(serialized_img)
-    seg = run_lungair_seg_inference(itk_img, './segmentLungsModel-v1.0.ckpt')
-    return convert_itk_to_vtkjs_image(seg)
+async def run_lung_segmentation_volume_process(img, shared_seg, axis, batch_size, channel=None):
+    """Segment `img` slice by slice into `shared_seg`.
 
-async def run_lung_segmentation_process(img):
-    serialized_img = convert_itk_to_vtkjs_image(img)
-    loop = asyncio.get_event_loop()
-    serialized_output = await loop.run_in_executor(
-        process_pool, do_lung_segmentation, serialized_img
-    )
-    return convert_vtkjs_to_itk_image(serialized_output)
+    Slice batches are spread over the segmentation workers; yields (slices done, total)
+    as each batch completes.
+    """
+    shared_img = share_input(img, "segmentLungsVolume")
+    try:
+        total = shared_img.shape[axis]
+        batches = [
+            asyncio.ensure_future(
+                run_in_pool(
+                    "segmentation",
+                    "segmentLungsVolume",
+                    do_lung_segmentation_slices,
+                    shared_img,
+                    shared_seg,
+                    axis,
+                    start,
+                    min(start + batch_size, total),
+                    channel,
+                )
+            )
+            for start in range(0, total, batch_size)
+        ]
+        done = 0
+        try:
+            for batch in asyncio.as_completed(batches):
+                done += await batch
+                yield done, total
+        finally:
+            for batch in batches:
+                batch.cancel()
+    finally:
+        release_shared_image(shared_img)
 
 async def getDataID(imageID: str):
     dicomStore = get_current_client_store('dicom')
-    volumeKey = dicomStore.imageIDToVolumeKey[imageID]
+    volumeKey = await dicomStore.imageIDToVolumeKey[imageID]
     return volumeKey if volumeKey else imageID
 
-@volview.expose("segmentLungs")
-async def segment_lungs(img_id):
-    print(f"Started segmentLungs on {img_id} ...")
-    store = get_current_client_store("images")
+## Segmentation transfer ##
+# Label maps are uploaded to the client in one of these encodings:
+#   full: the uint8 labels as computed, at the image resolution (the default)
+#   lowres: uint8 labels subsampled to at most `lowres_size` pixels along each
+#     axis, with the spacing scaled to keep the physical extent, so that the
+#     viewer upsamples them on display. For a 2048x2048 radiograph this is 16
+#     times smaller than the full encoding.
+# Only the upload is affected: results are cached at full resolution, and the
+# image is still read from the client at full resolution.
+
+TRANSFER_MODES = ("full", "lowres")
+
+
+def parse_transfer_options(options):
+    """Pop the transfer options from a request's options.
+
+    Returns the remaining options, the transfer mode and the low-res size.
+    """
+    options = dict(options or {})
+    transfer = options.pop("transfer", "full")
+    lowres_size = int(options.pop("lowres_size", max(config.SEG_INPUT_SIZE)))
+    if transfer not in TRANSFER_MODES:
+        raise ValueError(f"Unknown transfer mode: {transfer}")
+    if lowres_size < 1:
+        raise ValueError("lowres_size must be at least 1")
+    return options, transfer, lowres_size
+
+
+def encode_segmentation(segout, transfer: str, lowres_size: int, keep_axis: int = None, dtype=np.uint8):
+    """Convert a label map to the given transfer encoding.
+
+    `keep_axis` is an ITK axis that is never subsampled, e.g. the slicing axis
+    of a volume segmented slice by slice. Probability maps are encoded with
+    `dtype=None`, which keeps their pixel type.
+    """
+    import itk
+
+    if transfer == "full":
+        return segout
+
+    labels = itk.array_view_from_image(segout)
+    spacing = list(segout.GetSpacing())
+    index = []
+    # NumPy axes are in (k, j, i) order, the reverse of the ITK axes.
+    for array_axis, size in enumerate(labels.shape):
+        axis = labels.ndim - 1 - array_axis
+        step = 1 if axis == keep_axis else max(1, -(-size // lowres_size))
+        spacing[axis] *= step
+        index.append(slice(None, None, step))
+    labels = labels[tuple(index)]
+
+    # Nearest-neighbor subsampling keeps the center of the first pixel, so the
+    # origin is unchanged.
+    result = itk.image_from_array(np.ascontiguousarray(labels, dtype=dtype))
+    result.SetOrigin(segout.GetOrigin())
+    result.SetSpacing(spacing)
+    result.SetDirection(segout.GetDirection())
+    return result
+
+
+async def upload_segmentation(
+    store,
+    state,
+    img_id,
+    base_image_id,
+    segout,
+    operation="segmentLungs",
+    transfer="full",
+    lowres_size=max(config.SEG_INPUT_SIZE),
+    keep_axis=None,
+):
+    import itk
+
+    with stage_timer(operation, "encode"):
+        segout = encode_segmentation(segout, transfer, lowres_size, keep_axis)
+    metrics.inc(
+        "lungair_bytes_transferred_total",
+        itk.array_view_from_image(segout).nbytes,
+        direction="to_client",
+    )
+    with stage_timer(operation, "upload"):
+        return await _upload_segmentation(store, state, img_id, base_image_id, segout, operation)
+
+async def _upload_segmentation(store, state, img_id, base_image_id, segout, operation):
+    seg_id = await upload_derived(store, state, base_image_id, operation, f"{img_id}_seg", segout)
     # layerStore = get_current_client_store("layer")
-    state = get_current_session(default_factory=ClientState)
+    # parent = { 'type': 'dicom', 'dataID': await getDataID(f'{img_id}') }
+    # source = { 'type': 'image', 'dataID': seg_id }
+    # await layerStore.addLayer(parent, source)
+    return seg_id
+
+async def segment_with_probabilities(img, channel):
+    """Return the label and probability maps of `img`, each cached separately."""
+    params = {"checkpoint": checkpoint_version(SEG_MODEL_CHECKPOINT), "mode": "resize"}
+    key, segout = await lookup_cached(img, "segmentLungs", **params)
+    probability_key, probout = await lookup_cached(img, "segmentLungsProbability", **params)
+    if segout is None or probout is None:
+        segout, probout = await run_lung_segmentation_process(img, channel, probabilities=True)
+        await store_cached(key, segout, "segmentLungs")
+        await store_cached(probability_key, probout, "segmentLungs")
+    return segout, probout
 
+async def upload_probabilities(
+    store, state, img_id, base_image_id, probout, transfer="full", lowres_size=max(config.SEG_INPUT_SIZE)
+):
+    import itk
+
+    with stage_timer("segmentLungs", "encode"):
+        probout = encode_segmentation(probout, transfer, lowres_size, dtype=None)
+    metrics.inc(
+        "lungair_bytes_transferred_total",
+        itk.array_view_from_image(probout).nbytes,
+        direction="to_client",
+    )
+    with stage_timer("segmentLungs", "upload"):
+        return await upload_derived(
+            store, state, base_image_id, "segmentLungsProbability", f"{img_id}_lung_probability", probout
+        )
+
+async def segment_image(store, state, img_id, mode, window_options, probabilities, transfer, lowres_size):
+    """Segment one image as a job and upload its label map.
+
+    Returns the job and the ID of the uploaded label map, None if the job
+    was superseded.
+    """
     # Behavior: when a filter request occurs on a
     # processed image, we instead assume we are re-running
     # the operation on the original image.
     base_image_id = get_base_image(state, img_id)
-    img = await store.dataIndex[base_image_id]
 
-    # we need to run the filter in a subprocess,
-    # since itk blocks the GIL.
-    segout = await run_lung_segmentation_process(img)
+    async def run(job):
+        with stage_timer("segmentLungs", "fetch_image"):
+            img = await store.dataIndex[base_image_id]
+        # we need to run the filter in a subprocess,
+        # since itk blocks the GIL.
+        if probabilities:
+            return await segment_with_probabilities(img, job.channel)
+        if mode == "sliding_window":
+            compute = lambda: run_lung_segmentation_sliding_window_process(
+                img, window_options, job.channel
+            )
+        else:
+            compute = lambda: run_lung_segmentation_process(img, job.channel)
+        return await run_cached(
+            img,
+            "segmentLungs",
+            compute,
+            checkpoint=checkpoint_version(SEG_MODEL_CHECKPOINT),
+            mode=mode,
+            **window_options,
+        )
+
+    job = Job("segmentLungs", base_image_id, {"mode": mode, **window_options})
+    segout = await jobs.run(state.active_jobs, job, run)
+    if job.state == "cancelled":
+        print(f"segmentLungs on {img_id} was superseded.")
+        return job, None
     print(f"Completed segmentLungs on {img_id}.")
 
-    seg_id = state.image_id_map.get(base_image_id)
-    seg_exists_on_client_side = None
-    if seg_id:
-        seg_exists_on_client_side = await store.metadata[seg_id]
-        # seg_exists_on_client_side = await store.dataIndex[seg_id]
+    if probabilities:
+        segout, probout = segout
+        await upload_probabilities(store, state, img_id, base_image_id, probout, transfer, lowres_size)
 
-    print('seg_exists_on_client_side: ', seg_exists_on_client_side)
+    seg_id = await upload_segmentation(
+        store,
+        state,
+        img_id,
+        base_image_id,
+        segout,
+        transfer=transfer,
+        lowres_size=lowres_size,
+    )
+    return job, seg_id
 
-    if seg_id and seg_exists_on_client_side:
-        print(f"Updating existing segmentation image ID: {seg_id}.")
-        await store.updateData(seg_id, segout)
-    else:
-        seg_id = await store.addVTKImageData(f"{img_id}_seg", segout)
-        print(f"New segmentation image ID: {seg_id}.")
-        # Associate the segmented image ID with the base image ID.
-        associate_images(state, base_image_id, seg_id)
-        # volumeKey = getDataID()
-        # parent = { 'type': 'dicom', 'dataID': await getDataID(f'{img_id}') }
-        # source = { 'type': 'image', 'dataID': seg_id }
-        # await layerStore.addLayer(parent, source)
+@volview.expose("segmentLungs")
+@timed_request("segmentLungs")
+async def segment_lungs(img_id, options=None):
+    options, transfer, lowres_size = parse_transfer_options(options)
+    mode, window_options, probabilities = parse_segmentation_options(options)
+    print(f"Started segmentLungs on {img_id} ({mode}) ...")
+    store = get_current_client_store("images")
+    state = get_current_session(default_factory=ClientState)
+
+    job, _ = await segment_image(
+        store, state, img_id, mode, window_options, probabilities, transfer, lowres_size
+    )
+    return job.as_dict()
+
+@volview.expose("segmentLungsBatch")
+@timed_request("segmentLungsBatch")
+async def segment_lungs_batch(img_ids, options=None):
+    """Segment a list of images, streaming each result as it completes.
+
+    Accepts the same options as `segmentLungs`. The images are fetched,
+    segmented and uploaded concurrently, with at most
+    LUNGAIR_SEG_BATCH_IN_FLIGHT images held at a time; segmentations of
+    concurrent images share forward passes through the micro-batcher.
+    Each image is checked before it joins a forward pass, and a batch that
+    fails anyway is rerun image by image, so an image that cannot be
+    segmented yields a "failed" result with an "error" message while the
+    others complete.
+
+    If `img_ids` is a single image ID (a str) rather than a list, it is
+    passed to `segment_lungs_volume`, which segments that image slice by
+    slice, and its progress is yielded instead.
+
+    Yields, for each image, its job status with "image_id", "seg_id" (None
+    if the job was superseded or failed), and "done" and "total" image counts.
+    """
+    if isinstance(img_ids, str):
+        async for update in segment_lungs_volume(img_ids, options):
+            yield update
+        return
+
+    options, transfer, lowres_size = parse_transfer_options(options)
+    mode, window_options, probabilities = parse_segmentation_options(options)
+    print(f"Started segmentLungsBatch on {len(img_ids)} images ({mode}) ...")
+    store = get_current_client_store("images")
+    state = get_current_session(default_factory=ClientState)
+    in_flight = asyncio.Semaphore(config.SEG_BATCH_IN_FLIGHT)
+
+    async def segment_one(img_id):
+        async with in_flight:
+            try:
+                job, seg_id = await segment_image(
+                    store, state, img_id, mode, window_options, probabilities, transfer, lowres_size
+                )
+            except Exception as exc:
+                # validation and per-image batch retries confine the failure to this image
+                print(f"segmentLungsBatch failed on {img_id}: {exc}")
+                return {"image_id": img_id, "state": "failed", "error": str(exc), "seg_id": None}
+        return {**job.as_dict(), "image_id": img_id, "seg_id": seg_id}
+
+    tasks = [asyncio.ensure_future(segment_one(img_id)) for img_id in img_ids]
+    try:
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            yield {**(await task), "done": done, "total": len(tasks)}
+    finally:
+        # stop the remaining images if the client went away
+        for task in tasks:
+            task.cancel()
+    print(f"Completed segmentLungsBatch on {len(img_ids)} images.")
+
+@volview.expose("segmentLungsVolume")
+@timed_request("segmentLungsVolume")
+async def segment_lungs_volume(img_id, options=None):
+    """Segment a 3D image slice by slice with the 2D model, streaming progress.
+
+    Options:
+      axis: ITK index of the slicing axis (default 2, i.e. axial slices).
+      batch_size: slices per forward pass (default: sized to available memory).
+      transfer, lowres_size: encoding of the uploaded label map, see
+        TRANSFER_MODES; "lowres" keeps the full resolution along the axis.
+
+    Yields the job status with "done" and "total" slice counts after each
+    batch of slices, and finally the same with the "seg_id" of the uploaded
+    label map. A newer request for the same image cancels this one.
+    """
+    import itk
+
+    options, transfer, lowres_size = parse_transfer_options(options)
+    axis = int(options.pop("axis", 2))
+    batch_size = options.pop("batch_size", None)
+    if options:
+        raise ValueError(f"Unknown segmentation options: {', '.join(options)}")
+
+    print(f"Started segmentLungsVolume on {img_id} along axis {axis} ...")
+    store = get_current_client_store("images")
+    state = get_current_session(default_factory=ClientState)
+    base_image_id = get_base_image(state, img_id)
+    with stage_timer("segmentLungsVolume", "fetch_image"):
+        img = await store.dataIndex[base_image_id]
+
+    if img.GetNumberOfComponentsPerPixel() > 1 or img.GetImageDimension() != 3:
+        raise ValueError("segmentLungsVolume expects a 3D scalar image")
+    if not 0 <= axis < 3:
+        raise ValueError(f"Invalid slicing axis: {axis}")
+    array_axis = 2 - axis  # NumPy arrays are indexed (k, j, i)
+
+    key, segout = await lookup_cached(
+        img,
+        "segmentLungsVolume",
+        checkpoint=checkpoint_version(SEG_MODEL_CHECKPOINT),
+        axis=axis,
+    )
+    job = Job("segmentLungsVolume", base_image_id, {"axis": axis})
+    jobs.start(state.active_jobs, job)
+    job_state, error = "cancelled", None
+    try:
+        if segout is None:
+            if batch_size is None:
+                batch_size = config.slice_batch_size(num_workers=config.SEG_WORKERS)
+            batch_size = max(1, int(batch_size))
+
+            shape = itk.array_view_from_image(img).shape
+            shared_seg = allocate_shared_image(shape, np.uint8, img)
+            try:
+                async for done, total in run_lung_segmentation_volume_process(
+                    img, shared_seg, array_axis, batch_size, job.channel
+                ):
+                    if job.state == "cancelled":
+                        print(f"segmentLungsVolume on {img_id} was superseded.")
+                        yield job.as_dict()
+                        return
+                    job.report(done / total)
+                    print(f"segmentLungsVolume on {img_id}: {done}/{total} slices.")
+                    yield {**job.as_dict(), "done": done, "total": total}
+                segout = take_shared_image(shared_seg)
+            finally:
+                release_shared_image(shared_seg)
+            await store_cached(key, segout, "segmentLungsVolume")
+        print(f"Completed segmentLungsVolume on {img_id}.")
+
+        seg_id = await upload_segmentation(
+            store,
+            state,
+            img_id,
+            base_image_id,
+            segout,
+            "segmentLungsVolume",
+            transfer=transfer,
+            lowres_size=lowres_size,
+            keep_axis=axis,
+        )
+        job_state = "done"
+    except JobCancelled:
+        yield job.as_dict()
+        return
+    except Exception as exc:
+        job_state, error = "failed", str(exc)
+        raise
+    finally:
+        jobs.finish(state.active_jobs, job, job_state, error)
+    total = int(img.GetLargestPossibleRegion().GetSize()[axis])
+    yield {**job.as_dict(), "done": total, "total": total, "seg_id": seg_id}
+
+
+startup_report(metrics, import_started, heavy_modules=("itk", "torch", "monai", "lightning"))
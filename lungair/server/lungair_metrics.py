@@ -0,0 +1,300 @@
+import cProfile
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## Metrics ##
+# Requests are timed stage by stage: fetching the image from the client,
+# hashing, transport to the workers, queueing, checkpoint loading, pre- and
+# post-processing, the forward pass and the upload back to the client.
+# Timings recorded in a worker are handed back with its result and merged into
+# the server's registry, which renders them in the Prometheus text format.
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _format_bound(bound) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Thread-safe histograms, counters and gauges, keyed by name and labels.
+
+    Gauges can also be registered as functions, which are evaluated when the
+    metrics are rendered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(dict)
+        self._gauges = defaultdict(dict)
+        self._gauge_functions = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[name][key] = self._counters[name].get(key, 0) + value
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters[name].get(tuple(sorted(labels.items())), 0)
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[name][tuple(sorted(labels.items()))] = value
+
+    def gauge_function(self, name: str, fn, help_text: str = None):
+        """Register `fn` as a gauge. It returns a value, or a list of (labels dict, value) pairs."""
+        self._gauge_functions[name] = fn
+        if help_text:
+            self.describe(name, help_text)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def merge_stage_times(self, stage_times, **labels):
+        """Record timings collected in a worker by `timed`."""
+        for stage, seconds in stage_times:
+            self.observe("lungair_stage_seconds", seconds, stage=stage, **labels)
+
+    def _gauge_values(self):
+        gauges = {name: dict(values) for name, values in self._gauges.items()}
+        for name, fn in self._gauge_functions.items():
+            value = fn()
+            if isinstance(value, list):
+                gauges[name] = {tuple(sorted(labels.items())): v for labels, v in value}
+            else:
+                gauges[name] = {(): value}
+        return gauges
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        labels = _format_labels(key + (("le", _format_bound(bound)),))
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, series in sorted(self._gauge_values().items()):
+            header(name, "gauge")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Request counts, mean and approximate p50/p90 latency of every timed series."""
+        summary = {}
+        with self._lock:
+            for name, series in self._histograms.items():
+                for key, histogram in series.items():
+                    if histogram.count:
+                        summary[f"{name}{_format_labels(key)}"] = {
+                            "count": histogram.count,
+                            "mean_s": histogram.sum / histogram.count,
+                            "p50_s": histogram.quantile(0.5),
+                            "p90_s": histogram.quantile(0.9),
+                        }
+        return summary
+
+
+## Worker-side stage timings ##
+# Stages timed with `timed` in a worker are kept per thread until the pool
+# call that ran them collects them with `collect_stage_times`.
+
+_local = threading.local()
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if not hasattr(_local, "stage_times"):
+            _local.stage_times = []
+        _local.stage_times.append((stage, time.perf_counter() - start))
+
+
+def collect_stage_times() -> list:
+    stage_times = getattr(_local, "stage_times", [])
+    _local.stage_times = []
+    return stage_times
+
+
+def _profile_path(profile_dir, name, suffix):
+    os.makedirs(profile_dir, exist_ok=True)
+    return os.path.join(profile_dir, f"{name}-{os.getpid()}-{time.time_ns()}{suffix}")
+
+
+def call_with_metrics(submitted: float, profile, fn, *args):
+    """Run `fn(*args)` in a worker and return its result with the worker's stage timings.
+
+    `submitted` is the wall-clock time at which the call was queued. `profile`
+    is None, or a (profiler, directory) pair with profiler "cprofile" or
+    "torch", to capture a profile of this call.
+    """
+    collect_stage_times()
+    stage_times = [("queue_wait", max(0.0, time.time() - submitted))]
+    start = time.perf_counter()
+    if profile is None:
+        result = fn(*args)
+    else:
+        result = _call_profiled(profile, fn, *args)
+    stage_times += collect_stage_times()
+    stage_times.append(("worker_busy", time.perf_counter() - start))
+    return result, stage_times
+
+
+def _call_profiled(profile, fn, *args):
+    profiler, profile_dir = profile
+    name = getattr(fn, "__name__", "call")
+    if profiler == "torch":
+        import torch.profiler
+
+        with torch.profiler.profile(record_shapes=True) as prof:
+            result = fn(*args)
+        path = _profile_path(profile_dir, name, ".json")
+        prof.export_chrome_trace(path)
+    else:
+        prof = cProfile.Profile()
+        result = prof.runcall(fn, *args)
+        path = _profile_path(profile_dir, name, ".prof")
+        prof.dump_stats(path)
+    print(f"Saved {profiler} profile of {name} to {path}.")
+    return result
+
+
+## Startup ##
+
+
+def startup_report(registry: MetricsRegistry, started: float, heavy_modules=()):
+    """Print and record the time since `started` and the memory of the server
+    process, and which of `heavy_modules` it has loaded."""
+    seconds = time.perf_counter() - started
+    # ru_maxrss is in KiB on Linux
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    loaded = [name for name in heavy_modules if name in sys.modules]
+    registry.set_gauge("lungair_startup_seconds", seconds)
+    registry.set_gauge("lungair_startup_peak_rss_bytes", rss_mb * 2**20)
+    print(
+        f"LungAir methods ready in {seconds:.2f} s, peak RSS {rss_mb:.0f} MiB"
+        f"{', loaded ' + ', '.join(loaded) if loaded else ''}."
+    )
+
+
+## Exporters ##
+
+
+def start_metrics_server(registry: MetricsRegistry, port: int, host: str = "0.0.0.0"):
+    """Serve `registry.render()` at /metrics on a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="lungair-metrics", daemon=True).start()
+    print(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
+
+
+def start_metrics_log(registry: MetricsRegistry, interval: float):
+    """Print a summary of the timed stages every `interval` seconds."""
+
+    def log():
+        while True:
+            time.sleep(interval)
+            summary = registry.summary()
+            if not summary:
+                continue
+            print("Metrics summary:")
+            for series, stats in sorted(summary.items()):
+                print(
+                    f"  {series}: {stats['count']} calls, mean {stats['mean_s'] * 1000:.1f} ms, "
+                    f"p50 <= {stats['p50_s'] * 1000:.0f} ms, p90 <= {stats['p90_s'] * 1000:.0f} ms"
+                )
+
+    threading.Thread(target=log, name="lungair-metrics-log", daemon=True).start()
@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+## Session state bounds ##
+# Each session remembers the images it derived from the client's images
+# (blurred images, label maps, probability maps) so that later requests update
+# them in place. The registry is bounded by entry count and age, and entries
+# whose data the client removed are pruned against the client's ID list in a
+# single call. Data the server itself holds for sessions, such as resident
+# base images, is charged to a budget shared by all sessions.
+
+
+def _params_key(params: dict) -> str:
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+@dataclass
+class DerivedImage:
+    image_id: str
+    base_id: str
+    operation: str
+    params: dict
+    created: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+
+
+class DerivedImageRegistry:
+    """Client-side images derived from base images, keyed by (base image, operation, parameters).
+
+    Keeps at most `max_entries` entries, dropping the least recently used
+    first, and forgets entries unused for `ttl` seconds. Forgotten images stay
+    on the client; a new request derives a new image.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (base, operation, params) -> DerivedImage
+        self._bases = {}  # derived image ID -> base image ID
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, base_id: str, operation: str, **params) -> str:
+        """Return the ID of the image derived from `base_id`, or None."""
+        self._expire()
+        key = (base_id, operation, _params_key(params))
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry.last_used = time.time()
+        self._entries.move_to_end(key)
+        return entry.image_id
+
+    def add(self, base_id: str, operation: str, image_id: str, **params):
+        key = (base_id, operation, _params_key(params))
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bases.pop(previous.image_id, None)
+        self._entries[key] = DerivedImage(image_id, base_id, operation, params)
+        self._bases[image_id] = base_id
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def base_of(self, image_id: str) -> str:
+        """Return the base image of a derived image, or the image itself."""
+        return self._bases.get(image_id, image_id)
+
+    def prune(self, client_ids) -> int:
+        """Forget derived images missing from `client_ids`, and those derived from
+        missing base images. Returns the number of entries dropped."""
+        client_ids = set(client_ids)
+        stale = [
+            key
+            for key, entry in self._entries.items()
+            if entry.image_id not in client_ids or entry.base_id not in client_ids
+        ]
+        for key in stale:
+            self._drop(key)
+        return len(stale)
+
+    def as_list(self):
+        return [
+            {
+                "image_id": entry.image_id,
+                "base_id": entry.base_id,
+                "operation": entry.operation,
+                "params": entry.params,
+            }
+            for entry in self._entries.values()
+        ]
+
+    def _expire(self):
+        if not self.ttl:
+            return
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.last_used < deadline]
+        for key in expired:
+            self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        if self._bases.get(entry.image_id) == entry.base_id:
+            del self._bases[entry.image_id]
+
+
+class MemoryBudget:
+    """Bytes held by the server on behalf of all sessions.
+
+    Each charge comes with a `release` callback. When the total exceeds
+    `max_bytes`, the least recently used charges are released, whichever
+    session they belong to. Charges whose `in_use` callback returns true, e.g.
+    images read by jobs in flight, are skipped, and released by a later
+    `charge` or `trim` once idle. The latest charge is never released by
+    itself, so that its owner can go on using it. Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+        self._charges = OrderedDict()  # key -> (nbytes, release, in_use)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._charges)
+
+    def charge(self, key, nbytes: int, release, in_use=None):
+        with self._lock:
+            if key in self._charges:
+                self.nbytes -= self._charges.pop(key)[0]
+            self._charges[key] = (nbytes, release, in_use)
+            self.nbytes += nbytes
+            evicted = self._evict()
+        # release outside the lock, since callbacks may discharge other keys
+        for evicted_release in evicted:
+            evicted_release()
+
+    def trim(self):
+        """Release idle charges until the total fits `max_bytes` again."""
+        with self._lock:
+            evicted = self._evict()
+        for evicted_release in evicted:
+            evicted_release()
+
+    def clear(self):
+        """Release all charges."""
+        with self._lock:
+            releases = [release for _, release, _ in self._charges.values()]
+            self._charges.clear()
+            self.nbytes = 0
+        for release in releases:
+            release()
+
+    def _evict(self):
+        evicted = []
+        latest = next(reversed(self._charges), None)
+        for key, (size, release, in_use) in list(self._charges.items()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key == latest or (in_use is not None and in_use()):
+                continue
+            del self._charges[key]
+            self.nbytes -= size
+            self.evictions += 1
+            evicted.append(release)
+        return evicted
+
+    def touch(self, key):
+        with self._lock:
+            if key in self._charges:
+                self._charges.move_to_end(key)
+
+    def discharge(self, key):
+        with self._lock:
+            charge = self._charges.pop(key, None)
+            if charge is not None:
+                self.nbytes -= charge[0]
@@ -1,11 +1,21 @@
-import monai
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+import time
 import numpy as np
 import torch
+import torch.nn.functional as F
 import lightning as L
 from monai.networks.nets import UNETR
+from monai.inferers import sliding_window_inference
 import itk
-from monai.transforms import ( Compose, Resized, 
-                              ToTensord, NormalizeIntensityd, EnsureChannelFirstd, Invertd)
+import lungair_config as config
+from lungair_metrics import timed
+
+INPUT_SIZE = config.SEG_INPUT_SIZE
+NUM_CLASSES = 2
 
 class NetInference(L.LightningModule):
     def __init__(self, input_size, num_classes):
@@ -16,52 +26,451 @@ class NetInference(L.LightningModule):
     def forward(self,x):
         x = self.model(x)
         return x
-    
-def run_lungair_seg_inference(itk_img: itk.image, model_checkpoint: str) -> itk.image:
-    input_img = itk.array_from_image(itk_img).astype(int).squeeze()
-    input_size = [512,512]
-    num_classes = 2
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = NetInference.load_from_checkpoint(model_checkpoint, input_size=input_size, num_classes=num_classes, strict=False, map_location=device)
-    model.eval() # Evaluation mode
-
-    assert len(input_img.shape) == 2, f"Expected input image of dimension 2, got: {len(input_img.shape)}"
-
-    pre_transforms = Compose([EnsureChannelFirstd(keys = ["image"], channel_dim = 'no_channel'),
-                            ToTensord(keys = ["image"]),
-                            Resized(keys=['image'], spatial_size = (512,512), mode=("bilinear")),
-                            NormalizeIntensityd(keys=['image'])])
-
-    input_dict = {}
-    input_dict["image"] = input_img
-
-    # Apply preprocessing
-    transform_dict = pre_transforms(input_dict)
-
-    # Run inference
-    if torch.cuda.is_available():
-        transform_img = transform_dict["image"][None].cuda() # Add in batch dimension
+
+
+## Process-local model registry ##
+# Models are keyed by (checkpoint path, checkpoint mtime, device) so that a
+# worker keeps its model warm across requests and reloads it only when the
+# checkpoint file is replaced on disk.
+
+_model_registry = {}
+
+def get_device() -> torch.device:
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def _model_key(model_checkpoint: str, device: torch.device):
+    path = os.path.abspath(model_checkpoint)
+    return (path, os.path.getmtime(path), str(device))
+
+def evict_model(model_checkpoint: str = None):
+    """Drop cached models for the given checkpoint, or all models if None."""
+    if model_checkpoint is None:
+        _model_registry.clear()
+        return
+    path = os.path.abspath(model_checkpoint)
+    for key in [key for key in _model_registry if key[0] == path]:
+        del _model_registry[key]
+    for key in [key for key in _engine_registry if key[0] == path]:
+        del _engine_registry[key]
+
+def get_model(model_checkpoint: str, device: torch.device = None) -> NetInference:
+    """Return the model for a checkpoint, loading it on first use or when the file changed."""
+    device = device if device is not None else get_device()
+    key = _model_key(model_checkpoint, device)
+    model = _model_registry.get(key)
+    if model is None:
+        # A different mtime means the checkpoint was replaced: evict the stale entry.
+        evict_model(model_checkpoint)
+        with timed("checkpoint_load"):
+            model = NetInference.load_from_checkpoint(model_checkpoint, input_size=INPUT_SIZE, num_classes=NUM_CLASSES, strict=False, map_location=device)
+            model.eval() # Evaluation mode
+            model.requires_grad_(False)
+        _model_registry[key] = model
+    return model
+
+## Inference engines ##
+# On CPU-only machines the model can run as an exported TorchScript or ONNX
+# (onnxruntime) graph, optionally with its linear layers, most of the UNETR
+# transformer, dynamically quantized to int8. Exported engines are cached next
+# to the checkpoint (or in the temp directory if that is not writable) and are
+# only kept if their segmentations agree with the fp32 model on calibration
+# images, with a Dice of at least SEG_MIN_DICE on each image where the fp32
+# model finds lungs; otherwise the fp32 model is used. The calibration images
+# are the radiographs of SEG_CALIBRATION_IMAGES, or synthetic chest-like ones.
+
+ENGINES = ("eager", "torchscript", "onnx")
+
+_engine_registry = {}
+
+class OnnxEngine:
+    """Runs an exported model with onnxruntime on CPU."""
+
+    def __init__(self, path: str):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        (logits,) = self.session.run(None, {"image": x.cpu().numpy()})
+        return torch.from_numpy(logits)
+
+def _engine_path(model_checkpoint: str, engine: str, quantize: bool) -> str:
+    stat = os.stat(model_checkpoint)
+    # engines are checked again against other calibration images
+    version = hashlib.blake2b(
+        repr((stat.st_size, stat.st_mtime_ns, torch.__version__, _calibration_version())).encode(), digest_size=8
+    ).hexdigest()
+    name = "{}.{}{}.{}{}".format(
+        os.path.basename(model_checkpoint),
+        engine,
+        "-int8" if quantize else "",
+        version,
+        ".onnx" if engine == "onnx" else ".pt",
+    )
+    directories = [os.path.dirname(os.path.abspath(model_checkpoint)), tempfile.gettempdir()]
+    for directory in directories:
+        if os.path.exists(os.path.join(directory, name)):
+            return os.path.join(directory, name)
+    for directory in directories:
+        if os.access(directory, os.W_OK):
+            return os.path.join(directory, name)
+    raise OSError(f"No writable directory to cache the {engine} engine of {model_checkpoint}")
+
+MAX_CALIBRATION_IMAGES = 16
+
+def _synthetic_radiographs(num_images: int = 4) -> list:
+    """Deterministic chest-like images, two dark lung fields on a brighter body with
+    noise, at several sizes and positions; the pattern of the server benchmarks."""
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(num_images):
+        size = (512, 1024, 768, 2048)[i % 4]
+        y, x = np.mgrid[-1 : 1 : size * 1j, -1 : 1 : size * 1j]
+        dx, dy = rng.uniform(-0.1, 0.1, 2)
+        width, height = rng.uniform(0.2, 0.3), rng.uniform(0.5, 0.7)
+        lungs = np.exp(-(((np.abs(x - dx) - 0.4) / width) ** 2 + ((y - dy) / height) ** 2))
+        image = 3000 * (1 - 0.7 * lungs) + rng.normal(0, 100, (size, size))
+        images.append(itk.image_from_array(np.clip(image, 0, 65535).astype(np.uint16)))
+    return images
+
+def _calibration_paths() -> list:
+    path = config.SEG_CALIBRATION_IMAGES
+    if not path:
+        return []
+    if not os.path.isdir(path):
+        return [path]
+    names = sorted(name for name in os.listdir(path) if not name.startswith("."))
+    return [os.path.join(path, name) for name in names][:MAX_CALIBRATION_IMAGES]
+
+def _calibration_version():
+    return [(path, os.path.getmtime(path)) for path in _calibration_paths()] or "synthetic"
+
+def _calibration_images() -> list:
+    paths = _calibration_paths()
+    if not paths:
+        return _synthetic_radiographs()
+    # color images are read as their luminance
+    return [itk.imread(path, itk.F) for path in paths]
+
+def _dice(reference: torch.Tensor, other: torch.Tensor) -> float:
+    """Dice of two masks, or None if the reference is empty, since agreeing on
+    finding nothing does not validate an engine."""
+    if not reference.any():
+        return None
+    return 2 * int((reference & other).sum()) / int(reference.sum() + other.sum())
+
+def _export_engine(module, engine: str, path: str):
+    example = torch.zeros(1, 1, *INPUT_SIZE)
+    if engine == "torchscript":
+        torch.jit.save(torch.jit.trace(module, example, check_trace=False), path)
+    else:
+        torch.onnx.export(
+            module,
+            example,
+            path,
+            input_names=["image"],
+            output_names=["logits"],
+            dynamic_axes={"image": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17,
+        )
+
+def _load_engine(engine: str, path: str, device: torch.device):
+    if engine == "torchscript":
+        return torch.jit.load(path, map_location=device)
+    return OnnxEngine(path)
+
+def _build_engine(model: NetInference, model_checkpoint: str, engine: str, quantize: bool, device: torch.device):
+    """Load the cached engine for a checkpoint, exporting and checking it first if needed."""
+    path = None if engine == "eager" else _engine_path(model_checkpoint, engine, quantize)
+    if path is not None and os.path.exists(path):
+        return _load_engine(engine, path, device)
+
+    module = model.model
+    if quantize and engine != "onnx":
+        module = torch.ao.quantization.quantize_dynamic(copy.deepcopy(module), {torch.nn.Linear}, dtype=torch.qint8)
+
+    candidate_dir = None
+    if engine == "eager":
+        candidate = module
     else:
-        transform_img = transform_dict["image"][None].cpu()
-
-    pred = model(transform_img)
-
-    # Output segmentation
-    pred.softmax(dim = 1) # Convert to probability map
-    pred = torch.argmax(pred, dim=1)
-    transform_dict["infer"] = pred
-
-    # Invert resize
-    post_trans = Invertd(keys = "infer", transform = pre_transforms, orig_keys = "image", nearest_interp = True)
-    output_dict = post_trans(transform_dict)
-
-    # Output segmentation
-    seg = output_dict["infer"].cpu().numpy()
-    seg = seg.astype(np.ushort)
-    PixelType = itk.ctype("unsigned short")
-    Dimension = 3
-    ImageType = itk.Image[PixelType, Dimension]
-    result = itk.image_from_array(seg, ttype=ImageType)
-    result.SetOrigin(itk_img.GetOrigin())
-    result.SetSpacing(itk_img.GetSpacing())
+        # Export under the final name in a scratch directory, since ONNX files
+        # may refer to external weight files by name.
+        candidate_dir = tempfile.mkdtemp(prefix=".lungair-engine-", dir=os.path.dirname(path))
+        candidate_path = os.path.join(candidate_dir, os.path.basename(path))
+        if engine == "onnx" and quantize:
+            # onnxruntime quantizes the exported fp32 graph itself
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            fp32_dir = os.path.join(candidate_dir, "fp32")
+            os.mkdir(fp32_dir)
+            fp32_path = os.path.join(fp32_dir, "model.onnx")
+            _export_engine(module, engine, fp32_path)
+            quantize_dynamic(fp32_path, candidate_path, weight_type=QuantType.QInt8)
+            shutil.rmtree(fp32_dir)
+        else:
+            _export_engine(module, engine, candidate_path)
+        candidate = _load_engine(engine, candidate_path, device)
+
+    scores = []
+    with torch.inference_mode():
+        for itk_img in _calibration_images():
+            batch = _preprocess_batch([itk_img]).to(device)
+            expected = torch.argmax(model(batch), dim=1).cpu() == 1
+            actual = torch.argmax(candidate(batch), dim=1).cpu() == 1
+            scores.append(_dice(expected, actual))
+    scores = [score for score in scores if score is not None]
+    dice = min(scores, default=None)
+    name = f"{engine}{' int8' if quantize else ''}"
+    if dice is None or dice < config.SEG_MIN_DICE:
+        if dice is None:
+            print(
+                f"Warning: {name} engine not validated, the fp32 model finds no lungs in the calibration "
+                "images (set LUNGAIR_SEG_CALIBRATION_IMAGES to radiographs); using the fp32 model."
+            )
+        else:
+            print(f"Warning: {name} engine rejected, Dice {dice:.4f} < {config.SEG_MIN_DICE}; using the fp32 model.")
+        if candidate_dir is not None:
+            shutil.rmtree(candidate_dir)
+        return model
+    print(f"Using the {name} engine (Dice at least {dice:.4f} against the fp32 model on {len(scores)} images).")
+    if candidate_dir is not None:
+        # Move the engine file last, so that it is only found once complete.
+        for file_name in sorted(os.listdir(candidate_dir), key=lambda name: name == os.path.basename(path)):
+            os.replace(os.path.join(candidate_dir, file_name), os.path.join(os.path.dirname(path), file_name))
+        os.rmdir(candidate_dir)
+    return candidate
+
+def get_engine(model_checkpoint: str, device: torch.device = None, engine: str = None, quantize: bool = None):
+    """Return a callable running the segmentation model with the configured engine.
+
+    Exported and quantized engines are CPU-only; on GPU the eager model is used.
+    """
+    engine = engine or config.SEG_ENGINE
+    quantize = config.SEG_QUANTIZE if quantize is None else quantize
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown inference engine: {engine}")
+    device = device if device is not None else get_device()
+    model = get_model(model_checkpoint, device)
+    if (engine == "eager" and not quantize) or device.type != "cpu":
+        return model
+
+    key = _model_key(model_checkpoint, device) + (engine, quantize)
+    compiled = _engine_registry.get(key)
+    if compiled is None:
+        with timed("engine_load"):
+            compiled = _build_engine(model, model_checkpoint, engine, quantize, device)
+        _engine_registry[key] = compiled
+    return compiled
+
+def warm_up(model_checkpoint: str):
+    """Load the model and run it once on a blank image, so that the first request
+    does not pay for lazy initialization in torch and the engine."""
+    device = get_device()
+    engine = get_engine(model_checkpoint, device)
+    with torch.inference_mode():
+        engine(torch.zeros(1, 1, *INPUT_SIZE, device=device))
+
+def init_inference_worker(model_checkpoint: str):
+    """ProcessPoolExecutor initializer that loads and warms up the model once per worker."""
+    start = time.perf_counter()
+    try:
+        warm_up(model_checkpoint)
+    except FileNotFoundError:
+        # Don't break the pool; the request itself will report the missing checkpoint.
+        print(f"Warning: segmentation checkpoint {model_checkpoint} not found, model not preloaded.")
+        return
+    print(f"Segmentation worker {os.getpid()} warmed up in {time.perf_counter() - start:.1f} s.")
+
+
+## Pre- and postprocessing ##
+# Equivalent to the MONAI pipeline the model was trained with (bilinear Resized
+# to INPUT_SIZE, then NormalizeIntensityd), and to inverting the resize with
+# nearest-neighbor interpolation, but as plain batched torch ops on float32
+# views of the ITK buffers. Labels are written straight into uint8 ITK images.
+# lungair/benchmarks/check_seg_inference.py compares both pipelines.
+
+def _image_tensor(itk_img: itk.image) -> torch.Tensor:
+    """View a 2D image as a float32 (1, 1, H, W) tensor, without copying float32 buffers."""
+    array = itk.array_view_from_image(itk_img).squeeze()
+    if array.ndim != 2:
+        raise ValueError(f"Expected input image of dimension 2, got: {array.ndim}")
+    return torch.as_tensor(np.asarray(array, dtype=np.float32))[None, None]
+
+def _normalize(x: torch.Tensor) -> torch.Tensor:
+    """NormalizeIntensityd on each image of a (N, 1, H, W) batch."""
+    mean = x.mean(dim=(1, 2, 3), keepdim=True)
+    std = x.std(dim=(1, 2, 3), keepdim=True, unbiased=False)
+    return (x - mean) / torch.where(std > 0, std, torch.ones_like(std))
+
+def _preprocess_batch(itk_imgs: list) -> torch.Tensor:
+    """Resize every image to INPUT_SIZE and normalize it, as a (N, 1, *INPUT_SIZE) batch."""
+    x = torch.cat([
+        F.interpolate(_image_tensor(itk_img), size=INPUT_SIZE, mode="bilinear", align_corners=False)
+        for itk_img in itk_imgs
+    ])
+    return _normalize(x)
+
+def _nearest_indices(in_size: int, out_size: int) -> np.ndarray:
+    """Source indices of F.interpolate(mode="nearest") along one axis."""
+    return np.minimum((np.arange(out_size) * (in_size / out_size)).astype(np.int64), in_size - 1)
+
+def _new_image(pixel_type, like_img: itk.image, shape) -> itk.image:
+    """Allocate a 3D image of the given (1, H, W) shape with the origin and spacing of `like_img`."""
+    result = itk.Image[pixel_type, 3].New()
+    result.SetRegions([int(size) for size in reversed(shape)])
+    result.Allocate()
+    result.SetOrigin(like_img.GetOrigin())
+    result.SetSpacing(like_img.GetSpacing())
+    return result
+
+def _labels_image(itk_img: itk.image, labels: np.ndarray) -> itk.image:
+    """Resize INPUT_SIZE labels back to the size of `itk_img`, into a new uint8 image."""
+    height, width = itk.array_view_from_image(itk_img).squeeze().shape
+    result = _new_image(itk.UC, itk_img, (1, height, width))
+    rows = labels[_nearest_indices(labels.shape[0], height)]
+    np.take(rows, _nearest_indices(labels.shape[1], width), axis=1, out=itk.array_view_from_image(result)[0])
+    return result
+
+def _probability_image(itk_img: itk.image, probabilities: torch.Tensor) -> itk.image:
+    """Resize an INPUT_SIZE probability map back to the size of `itk_img`, into a new float image."""
+    height, width = itk.array_view_from_image(itk_img).squeeze().shape
+    result = _new_image(itk.F, itk_img, (1, height, width))
+    resized = F.interpolate(probabilities[None, None], size=(height, width), mode="bilinear", align_corners=False)
+    itk.array_view_from_image(result)[0] = resized[0, 0].numpy()
     return result
+
+def run_lungair_seg_inference_batch(itk_imgs: list, model_checkpoint: str, return_probabilities: bool = False) -> list:
+    """Segment several 2D images with a single forward pass over the stacked batch.
+
+    Returns uint8 label maps, or (label map, lung probability map) pairs if
+    `return_probabilities` is set.
+    """
+    device = get_device()
+    model = get_engine(model_checkpoint, device)
+
+    with torch.inference_mode():
+        # Apply preprocessing; every image is resized to INPUT_SIZE so they stack.
+        with timed("preprocess"):
+            batch = _preprocess_batch(itk_imgs).to(device)
+
+        # Run inference
+        with timed("forward"):
+            logits = model(batch)
+            labels = torch.argmax(logits, dim=1).to(torch.uint8).cpu().numpy()
+            if return_probabilities:
+                probabilities = torch.softmax(logits, dim=1)[:, 1].float().cpu()
+
+        with timed("postprocess"):
+            segs = [_labels_image(itk_img, labels[i]) for i, itk_img in enumerate(itk_imgs)]
+            if not return_probabilities:
+                return segs
+            return [
+                (seg, _probability_image(itk_img, probabilities[i]))
+                for i, (itk_img, seg) in enumerate(zip(itk_imgs, segs))
+            ]
+
+def run_lungair_seg_inference(itk_img: itk.image, model_checkpoint: str, return_probabilities: bool = False):
+    return run_lungair_seg_inference_batch([itk_img], model_checkpoint, return_probabilities)[0]
+
+
+## Sliding-window inference ##
+# Instead of resizing the whole radiograph to INPUT_SIZE, the image is
+# normalized as a whole and tiles of `roi_size` are streamed through the model,
+# so detail is kept at native resolution and model memory is bounded by
+# `sw_batch_size` tiles regardless of the input size. Tiles whose size differs
+# from INPUT_SIZE are resampled to it, since UNETR has a fixed input size.
+
+def _num_windows(image_size, roi_size, overlap):
+    count = 1
+    for size, roi in zip(image_size, roi_size):
+        interval = max(int(roi * (1 - overlap)), 1)
+        count *= int(np.ceil(max(size - roi, 0) / interval)) + 1
+    return count
+
+def _tile_predictor(model, device, progress_callback=None, num_batches=1):
+    batches_done = 0
+
+    def predict(tiles):
+        nonlocal batches_done
+        tile_size = list(tiles.shape[2:])
+        tiles = tiles.to(device)
+        if tile_size != INPUT_SIZE:
+            tiles = F.interpolate(tiles, size=INPUT_SIZE, mode="bilinear", align_corners=False)
+        logits = model(tiles)
+        if tile_size != INPUT_SIZE:
+            logits = F.interpolate(logits, size=tile_size, mode="bilinear", align_corners=False)
+        batches_done += 1
+        if progress_callback is not None:
+            progress_callback(min(batches_done / num_batches, 1.0))
+        return logits.cpu()
+    return predict
+
+def run_lungair_seg_inference_sliding_window(itk_img: itk.image, model_checkpoint: str,
+                                            roi_size=INPUT_SIZE, overlap: float = 0.25,
+                                            sw_batch_size: int = 1,
+                                            progress_callback=None) -> itk.image:
+    """Segment a 2D image tile by tile at native resolution.
+
+    `progress_callback`, if given, is called with the fraction of tiles done
+    after every tile batch; raising from it aborts the inference.
+    """
+    device = get_device()
+    model = get_engine(model_checkpoint, device)
+
+    input_img = itk.array_view_from_image(itk_img).squeeze()
+    if len(input_img.shape) != 2:
+        raise ValueError(f"Expected input image of dimension 2, got: {len(input_img.shape)}")
+
+    with torch.inference_mode():
+        with timed("preprocess"):
+            # Same as NormalizeIntensityd on the whole image
+            image = _normalize(_image_tensor(itk_img))
+
+        num_batches = int(np.ceil(_num_windows(input_img.shape, roi_size, overlap) / sw_batch_size))
+        with timed("forward"):
+            logits = sliding_window_inference(
+                image,
+                roi_size=list(roi_size),
+                sw_batch_size=sw_batch_size,
+                predictor=_tile_predictor(model, device, progress_callback, num_batches),
+                overlap=overlap,
+                mode="gaussian",
+                sw_device=device,
+                device=torch.device("cpu"),
+            )
+
+        # Output segmentation, with the same (1, H, W) layout as the resize path
+        with timed("postprocess"):
+            result = _new_image(itk.UC, itk_img, (1, *input_img.shape))
+            itk.array_view_from_image(result)[0] = torch.argmax(logits[0], dim=0).to(torch.uint8).numpy()
+    return result
+
+
+## Slice-batched inference for volumes ##
+
+def run_lungair_seg_inference_slices(slices: np.ndarray, model_checkpoint: str) -> np.ndarray:
+    """Segment a stack of 2D slices of shape (N, H, W) in one forward pass.
+
+    Each slice goes through the same resize and normalization as a single
+    radiograph. Returns uint8 labels of shape (N, H, W).
+    """
+    device = get_device()
+    model = get_engine(model_checkpoint, device)
+
+    with torch.inference_mode():
+        with timed("preprocess"):
+            x = torch.as_tensor(np.asarray(slices, dtype=np.float32))[:, None] # Add in channel dimension
+            slice_size = list(x.shape[2:])
+            x = _normalize(F.interpolate(x, size=INPUT_SIZE, mode="bilinear", align_corners=False))
+
+        with timed("forward"):
+            pred = model(x.to(device))
+            labels = torch.argmax(pred, dim=1).to(torch.uint8).cpu().numpy()
+
+        # Invert resize
+        with timed("postprocess"):
+            rows = _nearest_indices(INPUT_SIZE[0], slice_size[0])
+            cols = _nearest_indices(INPUT_SIZE[1], slice_size[1])
+            return labels[:, rows][:, :, cols]
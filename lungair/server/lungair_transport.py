@@ -0,0 +1,165 @@
+import os
+import tempfile
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+from lungair_config import SHARED_IMAGE_DIR
+
+## Shared-memory image transport ##
+# Images are handed to pool workers as a memory-mapped pixel buffer plus a
+# small picklable header, instead of pickling a full vtk.js serialization.
+# On Linux the buffers live in /dev/shm, so they never touch the disk.
+# Their space is reserved when they are created: writing to a sparse file on a
+# full tmpfs (64 MB by default in Docker) kills the process with SIGBUS instead
+# of raising an error. When the shared directory is full, buffers go to the
+# temporary directory instead.
+
+
+@dataclass(frozen=True)
+class SharedImage:
+    path: str
+    shape: tuple
+    dtype: str
+    is_vector: bool
+    origin: tuple
+    spacing: tuple
+    direction: tuple
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def create_shared_file(nbytes: int, prefix: str = "lungair-", suffix: str = ".raw") -> str:
+    """Create a file of `nbytes` bytes for a shared buffer, with its space reserved.
+
+    Raises OSError if neither SHARED_IMAGE_DIR nor the temporary directory has room.
+    """
+    error = None
+    for directory in dict.fromkeys((SHARED_IMAGE_DIR, tempfile.gettempdir())):
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=directory)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, max(1, nbytes))
+            else:
+                os.ftruncate(fd, max(1, nbytes))
+            return path
+        except OSError as exc:
+            os.unlink(path)
+            error = exc
+            print(f"Could not allocate a {nbytes} byte shared buffer in {directory}: {exc}")
+        finally:
+            os.close(fd)
+    raise error
+
+
+def _new_buffer(shape, dtype):
+    dtype = np.dtype(dtype)
+    path = create_shared_file(int(np.prod(shape)) * dtype.itemsize)
+    return path, np.memmap(path, dtype=dtype, mode="r+", shape=tuple(shape))
+
+
+def share_image(itk_img) -> SharedImage:
+    """Copy an ITK image into a new shared buffer and return its header."""
+    import itk
+
+    array = itk.array_view_from_image(itk_img)
+    path, buffer = _new_buffer(array.shape, array.dtype)
+    buffer[...] = array
+    buffer.flush()
+    del buffer
+
+    return SharedImage(
+        path=path,
+        shape=tuple(array.shape),
+        dtype=array.dtype.str,
+        is_vector=itk_img.GetNumberOfComponentsPerPixel() > 1,
+        origin=tuple(itk_img.GetOrigin()),
+        spacing=tuple(itk_img.GetSpacing()),
+        direction=tuple(map(tuple, itk.array_from_matrix(itk_img.GetDirection()))),
+    )
+
+
+def allocate_shared_image(shape, dtype, like_img) -> SharedImage:
+    """Create a zero-filled shared buffer with the geometry of `like_img`.
+
+    Workers can fill disjoint parts of it in place through `open_shared_array`.
+    """
+    import itk
+
+    dtype = np.dtype(dtype)
+    path = create_shared_file(int(np.prod(shape)) * dtype.itemsize)
+
+    return SharedImage(
+        path=path,
+        shape=tuple(shape),
+        dtype=dtype.str,
+        is_vector=False,
+        origin=tuple(like_img.GetOrigin()),
+        spacing=tuple(like_img.GetSpacing()),
+        direction=tuple(map(tuple, itk.array_from_matrix(like_img.GetDirection()))),
+    )
+
+
+def open_shared_array(handle: SharedImage, writable: bool = False) -> np.ndarray:
+    """Map the pixel buffer as a NumPy array.
+
+    Read-only mappings are copy-on-write: local modifications are not shared.
+    Writable mappings write through to the buffer seen by other processes.
+    """
+    mode = "r+" if writable else "c"
+    return np.memmap(handle.path, dtype=handle.dtype, mode=mode, shape=handle.shape)
+
+
+def open_shared_image(handle: SharedImage):
+    """Return an ITK image viewing the shared buffer without copying it.
+
+    The buffer is mapped copy-on-write, so filters may modify the view without
+    affecting other processes. The image keeps the mapping alive.
+    """
+    import itk
+
+    array = open_shared_array(handle)
+    image = itk.image_view_from_array(array, is_vector=handle.is_vector)
+    image.SetOrigin(handle.origin)
+    image.SetSpacing(handle.spacing)
+    image.SetDirection(itk.matrix_from_array(np.array(handle.direction, dtype=float)))
+    return image
+
+
+def subsample_shared_image(handle: SharedImage, max_size: int):
+    """Copy every n-th pixel of a shared image along each axis into a new
+    shared image, so that no axis is larger than `max_size`.
+
+    Returns the new header and the step along each NumPy axis. The spacing is
+    scaled by the steps; the origin, the center of the first pixel, is kept.
+    """
+    array = open_shared_array(handle)
+    # vector images have a trailing component axis, which is kept whole
+    steps = tuple(max(1, -(-size // max_size)) for size in array.shape[: len(handle.spacing)])
+    subsampled = array[tuple(slice(None, None, step) for step in steps)]
+    path, buffer = _new_buffer(subsampled.shape, array.dtype)
+    buffer[...] = subsampled
+    buffer.flush()
+    # NumPy axes are in (k, j, i) order, the reverse of the ITK axes.
+    spacing = tuple(s * step for s, step in zip(handle.spacing, reversed(steps)))
+    return replace(handle, path=path, shape=subsampled.shape, spacing=spacing), steps
+
+
+def release_shared_image(handle: SharedImage):
+    try:
+        os.unlink(handle.path)
+    except FileNotFoundError:
+        pass
+
+
+def take_shared_image(handle: SharedImage):
+    """Open a shared image and release its buffer name.
+
+    The mapping stays valid after the file is unlinked, so the returned image
+    remains a zero-copy view owned by the caller.
+    """
+    image = open_shared_image(handle)
+    release_shared_image(handle)
+    return image
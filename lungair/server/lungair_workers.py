@@ -0,0 +1,122 @@
+import numpy as np
+
+from lungair_config import SEG_MODEL_CHECKPOINT
+from lungair_metrics import timed
+from lungair_transport import open_shared_array, open_shared_image, share_image
+
+## Workers ##
+# Functions run by the pool workers. They live apart from lungair_methods, so
+# that workers can unpickle them without importing the server methods and the
+# VolView server. ITK, torch, MONAI and Lightning are imported by the workers
+# only: the server process runs the event loop and moves images around, so it
+# starts without them and loads ITK's image support on the first request. With
+# the "thread" and "inline" executors, the workers are in the server process.
+
+
+def init_median_worker():
+    """Load the ITK median filter module before the first request needs it."""
+    import itk
+
+    itk.MedianImageFilter
+
+
+def init_segmentation_worker(model_checkpoint):
+    from lungair_seg_inference import init_inference_worker
+
+    init_inference_worker(model_checkpoint)
+
+
+def do_median_filter(shared_img, radius, channel=None):
+    import itk
+
+    if channel is not None:
+        channel.check()
+    img = open_shared_image(shared_img)
+    ImageType = type(img)
+
+    median_filter = itk.MedianImageFilter[ImageType, ImageType].New()
+    median_filter.SetInput(img)
+    median_filter.SetRadius(radius)
+
+    if channel is not None:
+        def on_progress():
+            channel.progress = median_filter.GetProgress()
+            if channel.cancelled:
+                median_filter.AbortGenerateDataOn()
+
+        median_filter.AddObserver(itk.ProgressEvent(), on_progress)
+
+    try:
+        with timed("median_filter"):
+            median_filter.Update()
+    except RuntimeError:
+        # ITK raises ProcessAborted when the filter is aborted
+        if channel is not None:
+            channel.check()
+        raise
+
+    output = median_filter.GetOutput()
+    with timed("share_output"):
+        return share_image(output)
+
+
+def do_lung_segmentation_batch(shared_imgs, channels, probabilities):
+    """Segment a batch of images. Returns a shared label map, or a (label map,
+    probability map) pair where `probabilities` is set, for each image."""
+    from lungair_seg_inference import run_lungair_seg_inference_batch
+
+    # Drop images whose jobs were cancelled while the batch was queued.
+    keep = [i for i, channel in enumerate(channels) if channel is None or not channel.cancelled]
+    shared_outputs = [None] * len(shared_imgs)
+    if not keep:
+        return shared_outputs
+
+    itk_imgs = [open_shared_image(shared_imgs[i]) for i in keep]
+    return_probabilities = any(probabilities[i] for i in keep)
+    outputs = run_lungair_seg_inference_batch(itk_imgs, SEG_MODEL_CHECKPOINT, return_probabilities)
+    with timed("share_output"):
+        for i, output in zip(keep, outputs):
+            if not return_probabilities:
+                shared_outputs[i] = share_image(output)
+            elif probabilities[i]:
+                shared_outputs[i] = (share_image(output[0]), share_image(output[1]))
+            else:
+                shared_outputs[i] = share_image(output[0])
+    return shared_outputs
+
+
+def do_lung_segmentation_sliding_window(shared_img, window_options, channel=None):
+    from lungair_seg_inference import run_lungair_seg_inference_sliding_window
+
+    def on_progress(progress):
+        channel.progress = progress
+        channel.check()
+
+    itk_img = open_shared_image(shared_img)
+    seg = run_lungair_seg_inference_sliding_window(
+        itk_img,
+        SEG_MODEL_CHECKPOINT,
+        progress_callback=on_progress if channel is not None else None,
+        **window_options,
+    )
+    with timed("share_output"):
+        return share_image(seg)
+
+
+def do_lung_segmentation_slices(shared_img, shared_seg, axis, start, stop, channel=None):
+    from lungair_seg_inference import run_lungair_seg_inference_slices
+
+    if channel is not None:
+        channel.check()
+    volume = open_shared_array(shared_img)
+    seg = open_shared_array(shared_seg, writable=True)
+    index = [slice(None)] * volume.ndim
+    index[axis] = slice(start, stop)
+    index = tuple(index)
+
+    slices = np.moveaxis(volume[index], axis, 0)
+    labels = run_lungair_seg_inference_slices(slices, SEG_MODEL_CHECKPOINT)
+    with timed("share_output"):
+        np.moveaxis(seg[index], axis, 0)[...] = labels
+        seg.flush()
+    return stop - start